@@ -0,0 +1,102 @@
+from collections import OrderedDict
+import asyncio
+import os
+import time
+
+import contributor_store
+
+# Per-worker read-through cache of contributor records, including negative lookups, so auth checks and
+# GET /contributors/{username} mostly skip Redis. Entries live for at most CONTRIBUTOR_CACHE_TTL seconds
+# (0 disables the cache), and the least recently used are evicted beyond CONTRIBUTOR_CACHE_SIZE entries.
+# Contributor writes publish the username on contributor_store.INVALIDATE_CHANNEL from inside their Lua scripts,
+# and every worker drops the entry when the message arrives - the TTL bounds staleness if messages are lost.
+CONTRIBUTOR_CACHE_SIZE = int(os.environ.get("CONTRIBUTOR_CACHE_SIZE",10000))
+CONTRIBUTOR_CACHE_TTL = float(os.environ.get("CONTRIBUTOR_CACHE_TTL",30))
+SUBSCRIBE_RETRY_SECONDS = 1
+
+class Contributor_Cache:
+    def __init__(self, max_entries=CONTRIBUTOR_CACHE_SIZE, ttl=CONTRIBUTOR_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # Bumped on every invalidation - a lookup only fills the cache if no invalidation happened while it
+        # was reading from Redis, so a write racing the read cannot leave a stale entry behind
+        self.generation = 0
+        self.subscribed = False
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    # Get a contributor's details, or None if not registered
+    async def get(self, redis_client, username):
+        entry = self.entries.get(username)
+        if entry is not None:
+            if entry[1] > time.monotonic():
+                self.entries.move_to_end(username)
+                self.hits += 1
+                return entry[0]
+            del self.entries[username]
+            self.expirations += 1
+        self.misses += 1
+        generation = self.generation
+        contributor = await contributor_store.get_contributor(redis_client,username)
+        if self.ttl > 0 and generation==self.generation:
+            self.entries[username] = (contributor,time.monotonic()+self.ttl)
+            self.entries.move_to_end(username)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return contributor
+
+    async def exists(self, redis_client, username):
+        return not await self.get(redis_client,username)==None
+
+    def invalidate(self, username):
+        self.generation += 1
+        if self.entries.pop(username,None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self.generation += 1
+        self.entries.clear()
+
+    # Apply invalidations published by every worker until cancelled. Messages may have been missed while
+    # (re)subscribing, so the whole cache is dropped each time a subscription is established.
+    async def listen(self, redis_client):
+        while True:
+            pubsub = redis_client.pubsub()
+            try:
+                await pubsub.subscribe(contributor_store.INVALIDATE_CHANNEL)
+                self.clear()
+                self.subscribed = True
+                async for message in pubsub.listen():
+                    if message["type"]=="message":
+                        self.invalidate(message["data"].decode())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.clear()
+                await asyncio.sleep(SUBSCRIBE_RETRY_SECONDS)
+            finally:
+                self.subscribed = False
+                await pubsub.aclose()
+
+    def stats(self):
+        lookups = self.hits+self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits/lookups if lookups else None,
+            "expirations": self.expirations,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "subscribed": self.subscribed
+        }
+
+# Process-wide contributor cache
+contributor_cache = Contributor_Cache()
@@ -0,0 +1,39 @@
+import struct
+
+# Contributor records are stored as a versioned, length-prefixed binary layout: a zero byte (which never starts a
+# legacy "name;bio" string, as names are alphanumeric), a version byte, then each field of that version in order
+# as a big-endian uint32 byte length followed by its UTF-8 bytes.
+# New fields are added by appending them to a new version - decoding fills fields missing from older records with
+# their defaults, and ignores trailing fields it does not know about.
+RECORD_MAGIC = b"\0"
+RECORD_VERSION = 1
+RECORD_FIELDS = ("name","bio")
+FIELD_DEFAULTS = {"name": "", "bio": ""}
+LENGTH = struct.Struct(">I")
+
+def encode_record(fields):
+    parts = [RECORD_MAGIC,bytes((RECORD_VERSION,))]
+    for field in RECORD_FIELDS:
+        data = fields.get(field,FIELD_DEFAULTS[field]).encode()
+        parts.append(LENGTH.pack(len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+def is_legacy(value):
+    return not value[:1]==RECORD_MAGIC
+
+# Decode a stored value in either format into a dict of every known field
+def decode_record(value):
+    if is_legacy(value):
+        name, _, bio = value.decode().partition(";")
+        return {**FIELD_DEFAULTS, "name": name, "bio": bio}
+    record = dict(FIELD_DEFAULTS)
+    position = 2
+    for field in RECORD_FIELDS:
+        if position >= len(value):
+            break
+        length = LENGTH.unpack_from(value,position)[0]
+        position += LENGTH.size
+        record[field] = value[position:position+length].decode()
+        position += length
+    return record
@@ -0,0 +1,225 @@
+from redis.commands.core import AsyncScript
+import base64
+import binascii
+import os
+
+from contributor_records import encode_record, decode_record, is_legacy
+
+# Contributors live in a single hash, keyed by username with records encoded by contributor_records. Values in
+# the legacy "name;bio" format are rewritten as records the first time they are read.
+# Two sorted sets index the hash for paging - all members have score 0 so they are ordered lexicographically:
+# contributors_by_username holds usernames, and contributors_by_name holds "<name>\0<username>" so names sort
+# first with username as tiebreak (\0 sorts below every character allowed in a name).
+# Every write is a single Lua script updating the hash and both indexes, so they stay consistent across
+# worker processes without any locking.
+USERS_KEY = "contributors"
+USERNAME_INDEX_KEY = "contributors_by_username"
+NAME_INDEX_KEY = "contributors_by_name"
+INDEX_KEYS = {"username": USERNAME_INDEX_KEY, "name": NAME_INDEX_KEY}
+
+# Every write and delete publishes the username here from inside its script, for per-worker caches to invalidate
+INVALIDATE_CHANNEL = "contributors_invalidate"
+
+# Page size for cursor-paginated listings when no count is given, and the most contributors a batch request
+# may write or read (each batch write runs as one script, blocking Redis while it does)
+CONTRIBUTOR_PAGE_SIZE = int(os.environ.get("CONTRIBUTOR_PAGE_SIZE",100))
+CONTRIBUTOR_BATCH_MAX = int(os.environ.get("CONTRIBUTOR_BATCH_MAX",1000))
+
+# Shared Lua helpers - the invalidation channel, reading the name out of a stored value in either format (it is
+# the first record field), and dropping a contributor's name index entry given their current hash value
+LUA_HELPERS = 'local invalidate_channel = "{}"'.format(INVALIDATE_CHANNEL)+"""
+local function record_name(value)
+    if string.byte(value, 1) ~= 0 then
+        return string.sub(value, 1, string.find(value, ";", 1, true) - 1)
+    end
+    local a, b, c, d = string.byte(value, 3, 6)
+    return string.sub(value, 7, 6 + ((a * 256 + b) * 256 + c) * 256 + d)
+end
+local function unindex_name(name_index, username, value)
+    if value then
+        redis.call("ZREM", name_index, record_name(value) .. "\\0" .. username)
+    end
+end
+"""
+
+# Set contributors' details and index them, in order. KEYS: users hash, username index, name index -
+# ARGV: mode, then (username, name, value) for each contributor. Mode "update" only writes contributors that
+# already exist. Returns 1 for each contributor that existed before, else 0.
+WRITE_SCRIPT = AsyncScript(None,(LUA_HELPERS+"""
+local existed = {}
+for i = 2, #ARGV, 3 do
+    local old = redis.call("HGET", KEYS[1], ARGV[i])
+    if ARGV[1] ~= "update" or old then
+        unindex_name(KEYS[3], ARGV[i], old)
+        redis.call("HSET", KEYS[1], ARGV[i], ARGV[i + 2])
+        redis.call("ZADD", KEYS[2], 0, ARGV[i])
+        redis.call("ZADD", KEYS[3], 0, ARGV[i + 1] .. "\\0" .. ARGV[i])
+        redis.call("PUBLISH", invalidate_channel, ARGV[i])
+    end
+    existed[#existed + 1] = old and 1 or 0
+end
+return existed
+""").encode())
+
+# Delete a contributor and their index entries. KEYS: users hash, username index, name index - ARGV: username.
+# Returns 1 if the contributor existed, else 0.
+DELETE_SCRIPT = AsyncScript(None,(LUA_HELPERS+"""
+local old = redis.call("HGET", KEYS[1], ARGV[1])
+if not old then return 0 end
+unindex_name(KEYS[3], ARGV[1], old)
+redis.call("HDEL", KEYS[1], ARGV[1])
+redis.call("ZREM", KEYS[2], ARGV[1])
+redis.call("PUBLISH", invalidate_channel, ARGV[1])
+return 1
+""").encode())
+
+# Rewrite legacy values as records, unless they changed since being read. KEYS: users hash -
+# ARGV: (username, legacy value, record) for each contributor.
+MIGRATE_SCRIPT = AsyncScript(None,b"""
+for i = 1, #ARGV, 3 do
+    if redis.call("HGET", KEYS[1], ARGV[i]) == ARGV[i + 1] then
+        redis.call("HSET", KEYS[1], ARGV[i], ARGV[i + 2])
+    end
+end
+""")
+
+def encode_contributor(name, bio):
+    return encode_record({"name": name, "bio": bio})
+
+# Register the scripts with Redis up front
+async def load_scripts(redis_client):
+    for script in (WRITE_SCRIPT,DELETE_SCRIPT,MIGRATE_SCRIPT):
+        script.sha = await redis_client.script_load(script.script)
+
+# Write (username, name, bio) tuples in one script call, returning whether each contributor existed before
+async def _write_contributors(redis_client, contributors, mode):
+    args = [mode]
+    for username, name, bio in contributors:
+        args += [username,name,encode_contributor(name,bio)]
+    existed = await WRITE_SCRIPT(keys=[USERS_KEY,USERNAME_INDEX_KEY,NAME_INDEX_KEY],args=args,client=redis_client)
+    return [i==1 for i in existed]
+
+# Add or overwrite a contributor, returning whether they are new
+async def set_contributor(redis_client, username, name, bio):
+    return not (await _write_contributors(redis_client,[(username,name,bio)],"set"))[0]
+
+# Add or overwrite many contributors in one round trip, returning whether each is new. Later entries for the
+# same username overwrite earlier ones.
+async def set_contributors(redis_client, contributors):
+    return [not i for i in await _write_contributors(redis_client,contributors,"set")]
+
+# Overwrite an existing contributor, returning whether they existed
+async def update_contributor(redis_client, username, name, bio):
+    return (await _write_contributors(redis_client,[(username,name,bio)],"update"))[0]
+
+# Decode (username, value) pairs into {"username", "name", "bio"} dicts, migrating any legacy values among them
+# in one round trip. Pairs with no value (deleted contributors) are left out.
+async def _decode_contributors(redis_client, items):
+    contributors = []
+    migrate_args = []
+    for username, value in items:
+        if value is None:
+            continue
+        contributor = decode_record(value)
+        if is_legacy(value):
+            migrate_args += [username,value,encode_record(contributor)]
+        contributors.append({"username": username.decode(), **contributor})
+    if migrate_args:
+        await MIGRATE_SCRIPT(keys=[USERS_KEY],args=migrate_args,client=redis_client)
+    return contributors
+
+# Get a contributor's details, or None if not registered
+async def get_contributor(redis_client, username):
+    contributors = await _decode_contributors(redis_client,[(username.encode(),await redis_client.hget(USERS_KEY,username))])
+    if not contributors:
+        return None
+    del contributors[0]["username"]
+    return contributors[0]
+
+# Get many contributors' details in one HMGET, as a dict by username of those registered
+async def get_contributors(redis_client, usernames):
+    values = await redis_client.hmget(USERS_KEY,usernames)
+    return {i.pop("username"): i for i in await _decode_contributors(redis_client,zip([i.encode() for i in usernames],values))}
+
+# Delete a contributor, returning whether they existed
+async def delete_contributor(redis_client, username):
+    return await DELETE_SCRIPT(keys=[USERS_KEY,USERNAME_INDEX_KEY,NAME_INDEX_KEY],args=[username],client=redis_client)==1
+
+# Fetch details for a page of index members, leaving out contributors deleted since the index was read
+async def _get_details(redis_client, members):
+    usernames = [i.split(b"\0")[-1] for i in members]
+    if not usernames:
+        return []
+    return await _decode_contributors(redis_client,zip(usernames,await redis_client.hmget(USERS_KEY,usernames)))
+
+# Get a page of contributors as {"username", "name", "bio"} dicts, ordered by username or name. The page is read
+# from the index and its details fetched with one HMGET, so cost depends on the page size and offset only.
+async def get_contributor_page(redis_client, sort_by="username", offset=0, count=None):
+    if count==0:
+        return []
+    members = await redis_client.zrange(INDEX_KEYS[sort_by],offset,-1 if count is None else offset+count-1)
+    return await _get_details(redis_client,members)
+
+# Cursors are the sort order and last index member of the previous page, base64-encoded so clients treat them
+# as opaque. Pages resume strictly after that member, so they cost the same however deep they are and do not
+# shift when earlier contributors are added or deleted.
+def encode_cursor(sort_by, member):
+    return base64.urlsafe_b64encode(sort_by.encode()+b":"+member).decode()
+
+# Returns the index member a cursor resumes after, or None if it is malformed or from another sort order
+def decode_cursor(sort_by, cursor):
+    try:
+        cursor_sort_by, _, member = base64.urlsafe_b64decode(cursor.encode()).partition(b":")
+    except (ValueError, binascii.Error):
+        return None
+    if not cursor_sort_by==sort_by.encode() or not member:
+        return None
+    return member
+
+# Get the page of count contributors after a cursor (from the start if cursor is None), skipping offset more.
+# Returns (contributors, next cursor) - the next cursor is None on the last page.
+async def get_contributor_page_after(redis_client, sort_by="username", cursor=None, count=CONTRIBUTOR_PAGE_SIZE, offset=0):
+    start = "-" if cursor is None else b"("+cursor
+    members = await redis_client.zrangebylex(INDEX_KEYS[sort_by],start,"+",offset,count+1)
+    next_cursor = encode_cursor(sort_by,members[count-1]) if len(members) > count else None
+    return await _get_details(redis_client,members[:count]), next_cursor
+
+# Yield every contributor as a {"username", "name", "bio"} dict, a batch at a time so memory stays flat however
+# many contributors there are. Unsorted walks the hash with HSCAN (contributors added or removed during the walk
+# may or may not be included), sorted walks the index with cursors.
+async def iter_contributors(redis_client, sort_by=None, batch_size=CONTRIBUTOR_PAGE_SIZE):
+    if sort_by is None:
+        cursor = 0
+        while True:
+            cursor, batch = await redis_client.hscan(USERS_KEY,cursor,count=batch_size)
+            for i in await _decode_contributors(redis_client,batch.items()):
+                yield i
+            if cursor==0:
+                return
+    member = None
+    while True:
+        start = "-" if member is None else b"("+member
+        members = await redis_client.zrangebylex(INDEX_KEYS[sort_by],start,"+",0,batch_size)
+        for i in await _get_details(redis_client,members):
+            yield i
+        if len(members) < batch_size:
+            return
+        member = members[-1]
+
+# Build the indexes for contributors stored before they existed - runs at startup if the username index
+# does not cover the hash. Returns the number of contributors indexed.
+async def rebuild_indexes(redis_client, batch_size=100):
+    if await redis_client.zcard(USERNAME_INDEX_KEY)==await redis_client.hlen(USERS_KEY):
+        return 0
+    indexed = 0
+    cursor = 0
+    while True:
+        cursor, batch = await redis_client.hscan(USERS_KEY,cursor,count=batch_size)
+        if batch:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.zadd(USERNAME_INDEX_KEY,{i: 0 for i in batch})
+            pipe.zadd(NAME_INDEX_KEY,{decode_record(batch[i])["name"].encode()+b"\0"+i: 0 for i in batch})
+            await pipe.execute()
+            indexed += len(batch)
+        if cursor==0:
+            return indexed
@@ -0,0 +1,168 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import concurrent.futures
+import io
+import os
+import threading
+import time
+
+# Output codecs for rendered images - PNG by default, lossless WebP, or raw BMP for internal callers. BMP is
+# only used for modes without alpha, as Pillow reads 32-bit BMPs back as RGB and drops the alpha channel.
+PNG_COMPRESS_LEVEL = int(os.environ.get("PNG_COMPRESS_LEVEL",6))
+WEBP_METHOD = int(os.environ.get("WEBP_METHOD",4))
+CODECS = {
+    "png": {"media_type": "image/png", "format": "PNG", "modes": None, "params": {"compress_level": PNG_COMPRESS_LEVEL}},
+    "webp": {"media_type": "image/webp", "format": "WEBP", "modes": ("L","LA","RGB","RGBA"), "params": {"lossless": True, "method": WEBP_METHOD}},
+    "bmp": {"media_type": "image/bmp", "format": "BMP", "modes": ("1","L","P","RGB"), "params": {}}
+}
+DEFAULT_CODEC = "png"
+
+# Encoded output is handed to the response in chunks of ENCODE_CHUNK_SIZE, with at most
+# ENCODE_QUEUE_CHUNKS chunks buffered ahead of the client. Streamed encodes run on a pool of ENCODE_THREADS
+# threads - the response waits on the event loop rather than holding a thread of its own.
+ENCODE_CHUNK_SIZE = 64*1024
+ENCODE_QUEUE_CHUNKS = 8
+ENCODE_PUT_TIMEOUT = 1
+ENCODE_THREADS = int(os.environ.get("ENCODE_THREADS",4))
+
+codec_stats_lock = threading.Lock()
+codec_stats = {i: {"encodes": 0, "encode_seconds": 0.0, "output_bytes": 0} for i in CODECS}
+
+# Pick a codec from an Accept header, honouring q-values - anything unrecognised falls back to PNG
+def negotiate_codec(accept):
+    if accept is None:
+        return DEFAULT_CODEC
+    media_types = {CODECS[i]["media_type"]: i for i in CODECS}
+    best_codec, best_q = DEFAULT_CODEC, 0.0
+    for entry in accept.split(","):
+        params = [i.strip() for i in entry.split(";")]
+        q = 1.0
+        for param in params[1:]:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        codec = media_types.get(params[0].lower())
+        if codec is not None and q > best_q:
+            best_codec, best_q = codec, q
+    return best_codec
+
+# Codec actually used for an image - falls back to PNG for modes the requested codec cannot hold losslessly
+def codec_for_mode(codec, mode):
+    modes = CODECS[codec]["modes"]
+    if modes is not None and mode not in modes:
+        return DEFAULT_CODEC
+    return codec
+
+# Work out the codec of encoded output from its signature
+def sniff_codec(content):
+    if content[:4]==b"RIFF" and content[8:12]==b"WEBP":
+        return "webp"
+    if content[:2]==b"BM":
+        return "bmp"
+    return "png"
+
+def record_encode(codec, seconds, output_bytes):
+    with codec_stats_lock:
+        codec_stats[codec]["encodes"] += 1
+        codec_stats[codec]["encode_seconds"] += seconds
+        codec_stats[codec]["output_bytes"] += output_bytes
+
+# Per-codec encode counts, latency and output size
+def get_codec_stats():
+    with codec_stats_lock:
+        stats = {i: dict(codec_stats[i]) for i in codec_stats}
+    for i in stats:
+        encodes = stats[i]["encodes"]
+        stats[i]["mean_encode_seconds"] = stats[i]["encode_seconds"]/encodes if encodes else None
+        stats[i]["mean_output_bytes"] = stats[i]["output_bytes"]/encodes if encodes else None
+    return stats
+
+# File-like sink for PIL's encoder, running in a pool thread, that cuts its output into fixed-size chunks on
+# a bounded queue read from the event loop. The encoder blocks once the queue is full, and aborts once the
+# reader is gone.
+class Chunk_Writer:
+    def __init__(self, loop):
+        self.loop = loop
+        self.chunks = asyncio.Queue(ENCODE_QUEUE_CHUNKS)
+        self.buffer = bytearray()
+        self.cancelled = False
+        self.total = 0
+
+    def _put(self, item):
+        future = asyncio.run_coroutine_threadsafe(self.chunks.put(item),self.loop)
+        while True:
+            if self.cancelled:
+                future.cancel()
+                raise IOError("encode cancelled")
+            try:
+                return future.result(ENCODE_PUT_TIMEOUT)
+            except concurrent.futures.TimeoutError:
+                continue
+
+    def write(self, data):
+        self.buffer += data
+        self.total += len(data)
+        while len(self.buffer) >= ENCODE_CHUNK_SIZE:
+            self._put(bytes(self.buffer[:ENCODE_CHUNK_SIZE]))
+            del self.buffer[:ENCODE_CHUNK_SIZE]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def finish(self, error=None):
+        if self.buffer:
+            self._put(bytes(self.buffer))
+            self.buffer = bytearray()
+        self._put(error)
+
+encode_executor = ThreadPoolExecutor(ENCODE_THREADS,thread_name_prefix="encode")
+
+def _encode_to_writer(img, codec, writer):
+    start = time.perf_counter()
+    error = None
+    try:
+        if writer.cancelled:
+            raise IOError("encode cancelled")
+        img.save(writer,format=CODECS[codec]["format"],**CODECS[codec]["params"])
+    except Exception as e:
+        error = e
+    finally:
+        img.close()
+    if error is None:
+        record_encode(codec,time.perf_counter()-start,writer.total)
+    try:
+        writer.finish(error)
+    except (IOError, RuntimeError):
+        pass
+
+# Encode a PIL image with the given codec on the encode pool, asynchronously yielding output chunks as the
+# encoder produces them. The image is closed once encoding ends, and encoding stops early if the generator is
+# closed before the end, as happens when the client disconnects.
+async def encode_image_chunks(img, codec):
+    loop = asyncio.get_running_loop()
+    writer = Chunk_Writer(loop)
+    loop.run_in_executor(encode_executor,_encode_to_writer,img,codec,writer)
+    try:
+        while True:
+            chunk = await writer.chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk,Exception):
+                raise chunk
+            yield chunk
+    finally:
+        writer.cancelled = True
+
+# Encode a PIL image in one go, in the calling thread
+def encode_image(img, codec):
+    start = time.perf_counter()
+    buffer = io.BytesIO()
+    try:
+        img.save(buffer,format=CODECS[codec]["format"],**CODECS[codec]["params"])
+    finally:
+        img.close()
+    record_encode(codec,time.perf_counter()-start,buffer.tell())
+    return buffer.getvalue()
@@ -0,0 +1,200 @@
+from starlette.concurrency import run_in_threadpool
+import asyncio
+import logging
+import os
+import socket
+import time
+
+from image_utils import check_png, normalize_png, apply_shitpost, frame_key
+from png_validator import BAD_PNG_ERR
+from image_workers import image_workers, Workers_Busy, Job_Timeout
+from render_cache import render_cache
+from image_upload import UPLOAD_MAX_BYTES
+import image_store
+
+# Asynchronous image ingestion - the upload is parked in chunks under imgupload_<id>_<n> and its identifier queued on a Redis
+# stream, and the request returns straight away. Every API worker runs a consumer in the ingest group (unless
+# INGEST_CONSUMER is 0), which
+# validates the upload, normalizes it, stores it and prerenders its first INGEST_PRERENDER_FRAMES fetches into
+# the render cache. Progress is kept in the imgingest_<id> hash (state queued/processing/done/failed, plus an
+# error if failed), which expires INGEST_STATUS_TTL seconds after the job ends.
+# Prerendered frames are kept in Redis for every worker to use (see render_cache) - with
+# RENDER_CACHE_PRERENDER_TTL and RENDER_CACHE_REDIS_TTL both 0 there is nowhere shared to keep them, so nothing
+# is prerendered.
+# Jobs left pending by a consumer that died are claimed by another one after INGEST_CLAIM_IDLE seconds, and
+# failed after INGEST_MAX_ATTEMPTS deliveries - unless the image was already stored, in which case the job is
+# just marked done. Uploads whose parked chunks expired before being processed fail with UPLOAD_EXPIRED.
+INGEST_STREAM_KEY = "image_ingest"
+INGEST_GROUP = "ingest"
+INGEST_UPLOAD_KEY_PREFIX = "imgupload_"
+INGEST_STATUS_KEY_PREFIX = "imgingest_"
+INGEST_PRERENDER_FRAMES = int(os.environ.get("INGEST_PRERENDER_FRAMES",3))
+INGEST_STATUS_TTL = int(os.environ.get("INGEST_STATUS_TTL",24*60*60))
+INGEST_CLAIM_IDLE = float(os.environ.get("INGEST_CLAIM_IDLE",60))
+INGEST_MAX_ATTEMPTS = int(os.environ.get("INGEST_MAX_ATTEMPTS",3))
+INGEST_CONSUMER = os.environ.get("INGEST_CONSUMER","1")=="1"
+# Kept below the Redis socket timeout, as a blocking read holds its connection silent for this long
+INGEST_BLOCK_SECONDS = 2
+INGEST_RETRY_SECONDS = 1
+
+UPLOAD_EXPIRED_ERR = "UPLOAD_EXPIRED"
+TOO_MANY_ATTEMPTS_ERR = "TOO_MANY_ATTEMPTS"
+
+QUEUED = "queued"
+PROCESSING = "processing"
+DONE = "done"
+FAILED = "failed"
+
+def upload_prefix(identifier):
+    return "{}{}_".format(INGEST_UPLOAD_KEY_PREFIX,identifier)
+
+def status_key(identifier):
+    return "{}{}".format(INGEST_STATUS_KEY_PREFIX,identifier)
+
+# Park an upload file, copying it in chunks, then queue it for ingestion - raises PNG_Error if it is too large.
+# Parked chunks expire along with the status, so uploads that are never processed do not linger.
+async def enqueue(redis_client, identifier, file, username):
+    _, chunks = await image_store.write_chunks(redis_client,upload_prefix(identifier),file,INGEST_STATUS_TTL,max_bytes=UPLOAD_MAX_BYTES)
+    pipe = redis_client.pipeline()
+    pipe.hset(status_key(identifier),mapping={"state": QUEUED, "username": username, "upload_chunks": chunks, "queued_at": time.time()})
+    pipe.xadd(INGEST_STREAM_KEY,{"identifier": identifier})
+    await pipe.execute()
+
+# Ingestion state of an image as a dict, or None if it was never queued or its status has expired
+async def get_status(redis_client, identifier):
+    status = await redis_client.hgetall(status_key(identifier))
+    if not status:
+        return None
+    status = {i.decode(): j.decode() for i, j in status.items()}
+    status.pop("username",None)
+    status.pop("upload_chunks",None)
+    status.pop("stored",None)
+    for i in ("queued_at","finished_at"):
+        if i in status:
+            status[i] = float(status[i])
+    if "attempts" in status:
+        status["attempts"] = int(status["attempts"])
+    return status
+
+# Render and encode a prerendered fetch as PNG, in the worker pool if enabled
+async def _prerender(file, fetch_count):
+    if image_workers.enabled:
+        return (await image_workers.render(file,fetch_count,"png"))[0]
+    return await run_in_threadpool(apply_shitpost,file,fetch_count,"png")
+
+logger = logging.getLogger(__name__)
+
+class Ingest_Worker:
+    def __init__(self, prerender_frames=INGEST_PRERENDER_FRAMES):
+        self.prerender_frames = prerender_frames
+        self.consumer = "{}-{}".format(socket.gethostname(),os.getpid())
+        self.ingested = 0
+        self.failed = 0
+        self.claimed = 0
+        self.prerendered = 0
+        self.prerender_errors = 0
+        self.ingest_seconds = 0.0
+
+    async def _finish(self, redis_client, identifier, message_id, state, chunks, error=None):
+        await image_store.delete_chunks(redis_client,upload_prefix(identifier),chunks)
+        pipe = redis_client.pipeline()
+        pipe.hset(status_key(identifier),mapping={"state": state, "finished_at": time.time(), **({} if error is None else {"error": error})})
+        pipe.expire(status_key(identifier),INGEST_STATUS_TTL)
+        pipe.xack(INGEST_STREAM_KEY,INGEST_GROUP,message_id)
+        pipe.xdel(INGEST_STREAM_KEY,message_id)
+        await pipe.execute()
+
+    async def process(self, redis_client, message_id, fields):
+        identifier = fields[b"identifier"].decode()
+        start = time.perf_counter()
+        attempts = await redis_client.hincrby(status_key(identifier),"attempts",1)
+        chunks, stored = await redis_client.hmget(status_key(identifier),"upload_chunks","stored")
+        chunks = int(chunks or 0)
+
+        # A retry of a job whose image was already stored has nothing left that matters
+        if not stored==None:
+            await self._finish(redis_client,identifier,message_id,DONE,chunks)
+            self.ingested += 1
+            return
+        if attempts > INGEST_MAX_ATTEMPTS:
+            self.failed += 1
+            await self._finish(redis_client,identifier,message_id,FAILED,chunks,TOO_MANY_ATTEMPTS_ERR)
+            return
+        file = await image_store.read_chunks(redis_client,upload_prefix(identifier),chunks)
+        if not file:
+            self.failed += 1
+            await self._finish(redis_client,identifier,message_id,FAILED,chunks,UPLOAD_EXPIRED_ERR)
+            return
+        await redis_client.hset(status_key(identifier),"state",PROCESSING)
+
+        # Validate and normalize, then store - the image becomes fetchable from here on
+        is_png, error_msg = await run_in_threadpool(check_png,file)
+        if not is_png:
+            self.failed += 1
+            await self._finish(redis_client,identifier,message_id,FAILED,chunks,error_msg)
+            return
+        try:
+            file = await run_in_threadpool(normalize_png,file)
+        except Exception:
+            self.failed += 1
+            await self._finish(redis_client,identifier,message_id,FAILED,chunks,BAD_PNG_ERR)
+            return
+        await image_store.store_image(redis_client,identifier,file,await run_in_threadpool(image_store.content_digest,file))
+        await redis_client.hset(status_key(identifier),"stored",1)
+
+        # Prerender the first fetches - this is only a head start for the render cache, so a busy worker pool or
+        # a failed render just means fewer frames are prepared
+        if render_cache.shared():
+            try:
+                generation = await image_store.get_generation(redis_client,identifier)
+                for fetch_count in range(1,self.prerender_frames+1):
+                    content = await _prerender(file,fetch_count)
+                    await render_cache.put(redis_client,identifier,generation,frame_key(fetch_count),"png",content,prerendered=True)
+                    self.prerendered += 1
+            except (Workers_Busy, Job_Timeout):
+                pass
+            except Exception:
+                self.prerender_errors += 1
+                logger.exception("Prerendering image %s failed",identifier)
+
+        await self._finish(redis_client,identifier,message_id,DONE,chunks)
+        self.ingested += 1
+        self.ingest_seconds += time.perf_counter()-start
+
+    # Consume ingestion jobs until cancelled, first claiming any left idle by dead consumers
+    async def run(self, redis_client):
+        while True:
+            try:
+                try:
+                    await redis_client.xgroup_create(INGEST_STREAM_KEY,INGEST_GROUP,id="0",mkstream=True)
+                except Exception as e:
+                    if "BUSYGROUP" not in str(e):
+                        raise
+                while True:
+                    _, messages, *_ = await redis_client.xautoclaim(INGEST_STREAM_KEY,INGEST_GROUP,self.consumer,int(INGEST_CLAIM_IDLE*1000),count=1)
+                    if messages:
+                        self.claimed += len(messages)
+                    else:
+                        response = await redis_client.xreadgroup(INGEST_GROUP,self.consumer,{INGEST_STREAM_KEY: ">"},count=1,block=INGEST_BLOCK_SECONDS*1000)
+                        messages = response[0][1] if response else []
+                    for message_id, fields in messages:
+                        if fields:
+                            await self.process(redis_client,message_id,fields)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                await asyncio.sleep(INGEST_RETRY_SECONDS)
+
+    def stats(self):
+        return {
+            "consumer": self.consumer,
+            "ingested": self.ingested,
+            "failed": self.failed,
+            "claimed": self.claimed,
+            "prerendered": self.prerendered,
+            "prerender_errors": self.prerender_errors,
+            "mean_ingest_seconds": self.ingest_seconds/self.ingested if self.ingested else None
+        }
+
+# Process-wide ingestion consumer
+ingest_worker = Ingest_Worker()
@@ -0,0 +1,340 @@
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+import io
+import hashlib
+import os
+from PIL import Image
+from redis.commands.core import AsyncScript
+
+from image_upload import iter_chunks
+from image_utils import png_to_pixels
+from pixel_format import is_pixels
+
+# Image identifiers map to content-addressed blobs - img_<id> holds the SHA-256 hex digest of the pristine
+# upload, and the upload itself is stored once under blob_<digest> however many images share it.
+# Blobs are split into BLOB_CHUNK_SIZE pieces under blobchunk_<digest>_<n>, with blob_<digest> a manifest hash
+# (size, chunk_size, chunks), so no Redis command ever moves more than one chunk. Chunks are written with a TTL
+# first, and the write script makes them permanent and creates the manifest in one step - the image only
+# switches over to a blob once it is complete.
+# Reference counts per digest live in the blob_refs hash, and blob_stats keeps running totals for dedup stats.
+# imgcount_<id> is a fetch counter - the N-th fetch is rendered directly from the original, so reads never
+# write image bytes back. imgver_<id> is a generation number bumped whenever the original changes, for keying
+# rendered output. Images stored before blobs existed keep the upload itself in img_<id>, and blobs stored
+# before chunking are single strings, until migrated.
+# With IMAGE_STORAGE_FORMAT set to pixels, new blobs hold the upload's decoded pixels (see pixel_format) instead
+# of the PNG, still keyed by the upload's digest - renders then skip decoding, at the cost of storing the pixels
+# uncompressed. Blobs in either format can be read whatever the setting.
+IMG_KEY_PREFIX = "img_"
+IMG_COUNT_KEY_PREFIX = "imgcount_"
+IMG_VERSION_KEY_PREFIX = "imgver_"
+BLOB_KEY_PREFIX = "blob_"
+BLOB_CHUNK_KEY_PREFIX = "blobchunk_"
+BLOB_REFS_KEY = "blob_refs"
+BLOB_STATS_KEY = "blob_stats"
+BLOB_CHUNK_SIZE = int(os.environ.get("BLOB_CHUNK_SIZE",256*1024))
+STAGING_TTL = 300
+IMAGE_STORAGE_FORMAT = os.environ.get("IMAGE_STORAGE_FORMAT","png")
+
+# Shared Lua helpers - whether a stored img_<id> value is a digest rather than a legacy inline upload, a blob's
+# size and its deletion whichever layout it has, making staged chunks permanent, and dropping one reference to
+# a blob (deleting it along with its refcount once unreferenced). Large values are freed with UNLINK, off
+# Redis's main thread.
+LUA_HELPERS = """
+local function is_digest(value)
+    return value and string.len(value) == 64 and not string.find(value, "[^0-9a-f]")
+end
+local function is_chunked(blob_key)
+    return redis.call("TYPE", blob_key)["ok"] == "hash"
+end
+local function blob_size(blob_key)
+    if is_chunked(blob_key) then
+        return tonumber(redis.call("HGET", blob_key, "size"))
+    end
+    return redis.call("STRLEN", blob_key)
+end
+local function delete_blob(blob_key, chunk_prefix)
+    if is_chunked(blob_key) then
+        for i = 0, tonumber(redis.call("HGET", blob_key, "chunks")) - 1 do
+            redis.call("UNLINK", chunk_prefix .. i)
+        end
+    end
+    redis.call("UNLINK", blob_key)
+end
+local function persist_chunks(chunk_prefix, chunks)
+    for i = 0, chunks - 1 do
+        if redis.call("EXISTS", chunk_prefix .. i) == 0 then return false end
+    end
+    for i = 0, chunks - 1 do
+        redis.call("PERSIST", chunk_prefix .. i)
+    end
+    return true
+end
+local function release(refs_key, stats_key, blob_prefix, chunk_prefix, digest)
+    local blob_key = blob_prefix .. digest
+    local size = blob_size(blob_key)
+    redis.call("HINCRBY", stats_key, "references", -1)
+    redis.call("HINCRBY", stats_key, "logical_bytes", -size)
+    if redis.call("HINCRBY", refs_key, digest, -1) <= 0 then
+        redis.call("HDEL", refs_key, digest)
+        delete_blob(blob_key, chunk_prefix .. digest .. "_")
+        redis.call("HINCRBY", stats_key, "unique_blobs", -1)
+        redis.call("HINCRBY", stats_key, "unique_bytes", -size)
+    end
+end
+"""
+
+# Point an image at a blob, creating the blob's manifest from its staged chunks if it is new, and releasing the
+# blob it previously pointed at.
+# KEYS: img, count, version, blob, refs, stats - ARGV: digest, mode, size, chunk count, chunk size, blob prefix,
+# chunk prefix, expected current value (migrate mode only).
+# Modes: "new" always writes, "replace" only writes if the image exists, and "migrate" only writes if the image
+# still holds the expected legacy value, keeping its fetch counter and generation.
+# Returns {0} if the condition failed, {-1} if the blob is missing and its chunks have to be staged (again) -
+# including when none were staged because the blob existed when checked, but was released before the script ran
+# - otherwise {1, previous value}.
+WRITE_SCRIPT = AsyncScript(None,(LUA_HELPERS+"""
+local old = redis.call("GET", KEYS[1])
+if ARGV[2] == "replace" and not old then return {0} end
+if ARGV[2] == "migrate" and old ~= ARGV[8] then return {0} end
+if redis.call("EXISTS", KEYS[4]) == 0 then
+    if tonumber(ARGV[4]) == 0 or not persist_chunks(ARGV[7] .. ARGV[1] .. "_", tonumber(ARGV[4])) then return {-1} end
+    redis.call("HSET", KEYS[4], "size", ARGV[3], "chunk_size", ARGV[5], "chunks", ARGV[4])
+    redis.call("HINCRBY", KEYS[6], "unique_blobs", 1)
+    redis.call("HINCRBY", KEYS[6], "unique_bytes", ARGV[3])
+end
+redis.call("HINCRBY", KEYS[5], ARGV[1], 1)
+redis.call("HINCRBY", KEYS[6], "references", 1)
+redis.call("HINCRBY", KEYS[6], "logical_bytes", blob_size(KEYS[4]))
+redis.call("SET", KEYS[1], ARGV[1])
+if ARGV[2] == "migrate" then
+    redis.call("SETNX", KEYS[2], 0)
+else
+    redis.call("SET", KEYS[2], 0)
+    redis.call("INCR", KEYS[3])
+end
+if is_digest(old) then
+    release(KEYS[5], KEYS[6], ARGV[6], ARGV[7], old)
+end
+return {1, old}
+""").encode())
+
+# Delete an image and release its blob. KEYS: img, count, version, refs, stats - ARGV: blob prefix, chunk prefix.
+# Returns 1 if the image existed, else 0.
+DELETE_SCRIPT = AsyncScript(None,(LUA_HELPERS+"""
+local old = redis.call("GET", KEYS[1])
+if not old then return 0 end
+redis.call("DEL", KEYS[1], KEYS[2], KEYS[3])
+if is_digest(old) then
+    release(KEYS[4], KEYS[5], ARGV[1], ARGV[2], old)
+end
+return 1
+""").encode())
+
+# Look up where an image's upload is, with its generation, in one round trip. KEYS: img, version - ARGV: blob
+# prefix. Returns {upload, generation} for uploads stored in a single value, {digest, generation, chunks} for
+# chunked blobs, or {false, false} if the image does not exist.
+READ_SCRIPT = AsyncScript(None,(LUA_HELPERS+"""
+local value = redis.call("GET", KEYS[1])
+if not value then return {false, false} end
+local generation = redis.call("GET", KEYS[2])
+if is_digest(value) then
+    local blob_key = ARGV[1] .. value
+    if is_chunked(blob_key) then
+        return {value, generation, redis.call("HGET", blob_key, "chunks")}
+    end
+    value = redis.call("GET", blob_key)
+end
+return {value, generation}
+""").encode())
+
+# Convert a blob stored as a single string to the chunked layout, once its chunks are staged. KEYS: blob -
+# ARGV: size, chunk count, chunk size, chunk prefix. Returns 1 if converted, 0 if the blob is gone or already
+# chunked, -1 if the chunks have to be staged again.
+CHUNK_SCRIPT = AsyncScript(None,(LUA_HELPERS+"""
+if redis.call("TYPE", KEYS[1])["ok"] ~= "string" or redis.call("STRLEN", KEYS[1]) ~= tonumber(ARGV[1]) then
+    return 0
+end
+if not persist_chunks(ARGV[4], tonumber(ARGV[2])) then return -1 end
+redis.call("UNLINK", KEYS[1])
+redis.call("HSET", KEYS[1], "size", ARGV[1], "chunk_size", ARGV[3], "chunks", ARGV[2])
+return 1
+""").encode())
+
+# Register the scripts with Redis up front, so the first call of each does not have to fall back from EVALSHA
+async def load_scripts(redis_client):
+    for script in (WRITE_SCRIPT,DELETE_SCRIPT,READ_SCRIPT,CHUNK_SCRIPT):
+        script.sha = await redis_client.script_load(script.script)
+
+# Write bytes or a file object as numbered keys <prefix><n> of up to BLOB_CHUNK_SIZE bytes each, one chunk per
+# command. Returns (size, chunk count). With nx, chunks that already exist are left alone - they can only hold
+# the same content, as prefixes are unique per content or per upload.
+async def write_chunks(redis_client, prefix, file, ttl=None, nx=False, max_bytes=None):
+    if isinstance(file,bytes):
+        file = io.BytesIO(file)
+    size = 0
+    chunks = 0
+    async for chunk in iterate_in_threadpool(iter_chunks(file,max_bytes,BLOB_CHUNK_SIZE)):
+        await redis_client.set("{}{}".format(prefix,chunks),chunk,ex=ttl,nx=nx)
+        size += len(chunk)
+        chunks += 1
+    return size, chunks
+
+# Read chunks written by write_chunks back into one bytes object (a bytearray if writable), or None if any of
+# them is missing
+async def read_chunks(redis_client, prefix, chunks, writable=False):
+    pipe = redis_client.pipeline(transaction=False)
+    for i in range(chunks):
+        pipe.get("{}{}".format(prefix,i))
+    parts = await pipe.execute()
+    if any(i is None for i in parts):
+        return None
+    return (bytearray() if writable else b"").join(parts)
+
+async def delete_chunks(redis_client, prefix, chunks):
+    if chunks > 0:
+        await redis_client.unlink(*["{}{}".format(prefix,i) for i in range(chunks)])
+
+def image_key(identifier):
+    return "{}{}".format(IMG_KEY_PREFIX,identifier)
+
+def count_key(identifier):
+    return "{}{}".format(IMG_COUNT_KEY_PREFIX,identifier)
+
+def version_key(identifier):
+    return "{}{}".format(IMG_VERSION_KEY_PREFIX,identifier)
+
+def blob_key(digest):
+    return "{}{}".format(BLOB_KEY_PREFIX,digest)
+
+def chunk_prefix(digest):
+    return "{}{}_".format(BLOB_CHUNK_KEY_PREFIX,digest)
+
+def content_digest(file):
+    return hashlib.sha256(file).hexdigest()
+
+def is_digest(value):
+    return len(value)==64 and all(i in b"0123456789abcdef" for i in value)
+
+# Upload in the form blobs are stored in - only converted when a blob is actually written, as deduplicated
+# uploads never need it
+async def _blob_content(file):
+    if IMAGE_STORAGE_FORMAT=="pixels" and not (isinstance(file,(bytes,bytearray)) and is_pixels(file)):
+        return await run_in_threadpool(png_to_pixels,file)
+    return file
+
+# Run the write script, staging the upload's chunks first unless Redis already holds the blob. file is either
+# the upload's bytes or a file object holding it. Staging is repeated if the blob or its chunks disappear
+# before the script runs, which only happens if its last other reference is dropped concurrently.
+async def _write_image(redis_client, identifier, file, digest, mode, expected=b""):
+    keys = [image_key(identifier),count_key(identifier),version_key(identifier),blob_key(digest),BLOB_REFS_KEY,BLOB_STATS_KEY]
+    size, chunks = 0, 0
+    if not await redis_client.exists(blob_key(digest)):
+        file = await _blob_content(file)
+        size, chunks = await write_chunks(redis_client,chunk_prefix(digest),file,STAGING_TTL,nx=True)
+    while True:
+        result = await WRITE_SCRIPT(keys=keys,args=[digest,mode,size,chunks,BLOB_CHUNK_SIZE,BLOB_KEY_PREFIX,BLOB_CHUNK_KEY_PREFIX,expected],client=redis_client)
+        if not result[0]==-1:
+            return result
+        file = await _blob_content(file)
+        size, chunks = await write_chunks(redis_client,chunk_prefix(digest),file,STAGING_TTL,nx=True)
+
+# Store a new image with a fresh fetch counter - the digest must be given if file is a file object
+async def store_image(redis_client, identifier, file, digest=None):
+    await _write_image(redis_client,identifier,file,digest or content_digest(file),"new")
+
+# Replace an existing image's original, restart its fetch counter and bump its generation.
+# Returns (existed, changed) - whether the image existed, and whether its content changed. As for store_image,
+# the digest must be given if file is a file object.
+async def replace_image(redis_client, identifier, file, digest=None):
+    digest = digest or content_digest(file)
+    result = await _write_image(redis_client,identifier,file,digest,"replace")
+    if result[0]==0:
+        return False, False
+    old_value = result[1]
+    changed = not old_value==digest.encode() if is_digest(old_value) else not content_digest(old_value)==digest
+    return True, changed
+
+# Delete an image with its counter and generation, returning whether the image existed
+async def delete_image(redis_client, identifier):
+    keys = [image_key(identifier),count_key(identifier),version_key(identifier),BLOB_REFS_KEY,BLOB_STATS_KEY]
+    return await DELETE_SCRIPT(keys=keys,args=[BLOB_KEY_PREFIX,BLOB_CHUNK_KEY_PREFIX],client=redis_client)==1
+
+# Atomically bump the fetch counter of an image, returning (fetch number, generation) or (None, None)
+# if it does not exist. Images written before counters existed start counting from their current contents
+# on first fetch, and are at generation 0 until their first update.
+async def fetch_image(redis_client, identifier):
+    pipe = redis_client.pipeline()
+    pipe.exists(image_key(identifier))
+    pipe.incr(count_key(identifier))
+    pipe.get(version_key(identifier))
+    exists, fetch_count, generation = await pipe.execute()
+    if not exists:
+        await redis_client.delete(count_key(identifier))
+        return None, None
+    return fetch_count, int(generation or 0)
+
+# Current generation of an image - 0 if it does not exist or predates generations
+async def get_generation(redis_client, identifier):
+    return int(await redis_client.get(version_key(identifier)) or 0)
+
+# Get original upload (or its pixels) together with its generation, or (None, None) if it does not exist.
+# Chunks are fetched after the manifest - if the blob is released in between, the image has changed, so the
+# lookup is redone. Chunked blobs are read into a bytearray, so stored pixels can be blended in place.
+async def get_original(redis_client, identifier):
+    while True:
+        file, generation, *chunks = await READ_SCRIPT(keys=[image_key(identifier),version_key(identifier)],args=[BLOB_KEY_PREFIX],client=redis_client)
+        if file is None:
+            return None, None
+        if chunks:
+            file = await read_chunks(redis_client,chunk_prefix(file.decode()),int(chunks[0]),writable=True)
+            if file is None:
+                continue
+        return file, int(generation or 0)
+
+# Deduplication stats - references are images pointing at blobs, logical bytes what storing every
+# image separately would take
+async def get_storage_stats(redis_client):
+    stats = {i.decode(): int(j) for i, j in (await redis_client.hgetall(BLOB_STATS_KEY)).items()}
+    stats = {i: stats.get(i,0) for i in ("unique_blobs","unique_bytes","references","logical_bytes")}
+    stats["dedup_ratio"] = stats["references"]/stats["unique_blobs"] if stats["unique_blobs"] else None
+    stats["bytes_saved"] = stats["logical_bytes"]-stats["unique_bytes"]
+    return stats
+
+# Migrate images stored before fetch counters and blobs existed - each legacy value already has all previous
+# fetches baked in, so it becomes the new original (moved into a blob) with a zeroed counter. Legacy values
+# rewritten as BMP by previous fetches are re-encoded as PNG. Images updated or deleted while being migrated
+# are skipped. Returns the number of migrated images.
+async def migrate_legacy_images(redis_client, batch_size=100):
+    migrated = 0
+    async for key in redis_client.scan_iter(match="{}*".format(IMG_KEY_PREFIX),count=batch_size):
+        identifier = key.decode()[len(IMG_KEY_PREFIX):]
+        value = await redis_client.get(key)
+        if value is None or is_digest(value):
+            continue
+        file = value
+        if file[:2]==b"BM":
+            with Image.open(io.BytesIO(file)) as img:
+                png_buffer = io.BytesIO()
+                img.save(png_buffer,format="PNG")
+            file = png_buffer.getvalue()
+        if (await _write_image(redis_client,identifier,file,content_digest(file),"migrate",value))[0]==1:
+            migrated += 1
+    return migrated
+
+# Convert blobs stored as single strings before chunking existed to the chunked layout. Blobs released while
+# being converted are skipped. Returns the number of converted blobs.
+async def chunk_legacy_blobs(redis_client, batch_size=100):
+    converted = 0
+    async for key in redis_client.scan_iter(match="{}*".format(BLOB_KEY_PREFIX),count=batch_size,_type="string"):
+        digest = key.decode()[len(BLOB_KEY_PREFIX):]
+        if not is_digest(digest.encode()):
+            continue
+        while True:
+            file = await redis_client.get(key)
+            if file is None:
+                break
+            size, chunks = await write_chunks(redis_client,chunk_prefix(digest),file,STAGING_TTL,nx=True)
+            result = await CHUNK_SCRIPT(keys=[key],args=[size,chunks,BLOB_CHUNK_SIZE,chunk_prefix(digest)],client=redis_client)
+            if not result==-1:
+                converted += result
+                break
+    return converted
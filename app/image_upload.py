@@ -0,0 +1,48 @@
+from PIL import Image
+import hashlib
+import os
+
+from png_validator import PNG_Validator, PNG_Error, BAD_PNG_ERR, PNG_TOO_LARGE_ERR
+from image_utils import PNG_STRICT
+
+# Uploads are handled as files (spooled to disk by the multipart parser past 1MB) and only ever read
+# UPLOAD_CHUNK_SIZE bytes at a time - validation and hashing run over the chunks in one pass, and uploads are
+# copied into Redis chunk by chunk (see image_store.write_chunks), so memory per upload is bounded by the chunk
+# size rather than the file size. Uploads over UPLOAD_MAX_BYTES are rejected, from Content-Length before the
+# body is read where the client sends one.
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE",256*1024))
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES",32*1024*1024))
+# Allowance for the multipart framing and form fields around the file when checking Content-Length
+UPLOAD_FORM_OVERHEAD = 64*1024
+
+# Read an upload from the start in chunks - raises PNG_Error(PNG_TOO_LARGE_ERR) as soon as it is over max_bytes,
+# if given
+def iter_chunks(file, max_bytes=UPLOAD_MAX_BYTES, chunk_size=UPLOAD_CHUNK_SIZE):
+    file.seek(0)
+    size = 0
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            return
+        size += len(chunk)
+        if not max_bytes==None and size > max_bytes:
+            raise PNG_Error(PNG_TOO_LARGE_ERR)
+        yield chunk
+
+# Validate and hash an upload in one pass, returning its SHA-256 hex digest - raises PNG_Error if it is
+# rejected. Strict mode decodes the pixels from the file afterwards, which does need the whole image in memory.
+def scan_upload(file, strict=PNG_STRICT):
+    validator = PNG_Validator()
+    digest = hashlib.sha256()
+    for chunk in iter_chunks(file):
+        validator.feed(chunk)
+        digest.update(chunk)
+    validator.finish()
+    if strict:
+        file.seek(0)
+        try:
+            with Image.open(file) as img:
+                img.load()
+        except Exception:
+            raise PNG_Error(BAD_PNG_ERR)
+    return digest.hexdigest()
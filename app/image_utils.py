@@ -1,50 +1,154 @@
 import io
+import os
+import threading
+import time
 from PIL import Image
 import numpy as np
 
-RICKROLL_FILE = "./perm_contents/rickroll_4k.png"
+from overlay_cache import overlay_cache
+from image_codecs import encode_image, codec_for_mode
+from pixel_format import is_pixels, encode_pixels, decode_pixels
+from png_validator import validate_png, strip_chunks, BAD_PNG_ERR
+
 RICKROLL_RATE = 0.1
-PNG_HEADER = bytes.fromhex("89504E470D0A1A0A")
 
-def check_png(file):
-    if not file[:len(PNG_HEADER)]==PNG_HEADER:
-        return False, "NOT_PNG_FILE"
-    file_buffer = io.BytesIO(file)
-    try:
-        img = Image.open(file_buffer)
-        img.close()
-        file_buffer.close()
-    except:
-        if not img==None: img.close()
-        file_buffer.close()
-        return False, "BAD_PNG_FILE"
+# Uploads are validated from their chunk structure alone - strict mode additionally decodes every pixel
+PNG_STRICT = os.environ.get("PNG_STRICT","0")=="1"
+
+# Fixed-point blending - pixel type -> (wider scratch type, fractional bits of the weights)
+BLEND_TYPES = {np.dtype(np.uint8): (np.uint16,8), np.dtype(np.uint16): (np.uint32,16)}
+BLEND_SCRATCH_BYTES = 4*1024*1024
+BLEND_MODES = ("L","LA","RGB","RGBA","I;16")
+
+blend_scratch = threading.local()
+
+def check_png(file, strict=PNG_STRICT):
+    is_png, result = validate_png(file)
+    if not is_png:
+        return False, result
+    if strict:
+        file_buffer = io.BytesIO(file)
+        try:
+            with Image.open(file_buffer) as img:
+                img.load()
+        except Exception:
+            return False, BAD_PNG_ERR
+        finally:
+            file_buffer.close()
     return True, None
 
-def apply_shitpost(file):
-    original_img_buffer = io.BytesIO(file)
-    original_img = Image.open(original_img_buffer)
-    original_img_data = np.array(original_img)
-    original_img.close()
-    original_img_buffer.close()
-
-    rickroll_original_img = Image.open(RICKROLL_FILE,"r")
-    rickroll_resized_img = rickroll_original_img.resize((original_img_data.shape[1],original_img_data.shape[0]))
-    rickroll_original_img.close()
-    rickroll_img_data = np.array(rickroll_resized_img)
-    rickroll_resized_img.close()
-    
-    original_img_data = original_img_data.astype(np.float64)
-    rickroll_img_data = rickroll_img_data.astype(np.float64)
-    if rickroll_img_data.shape[2]<original_img_data.shape[2]:
-        rickroll_img_data = np.concatenate([rickroll_img_data,255*np.ones((rickroll_img_data.shape[0],rickroll_img_data.shape[1],1))],axis=2)
-    new_img_data = (1-RICKROLL_RATE)*original_img_data + RICKROLL_RATE*rickroll_img_data
-    new_img_data = new_img_data.astype(np.uint8)
-    
-    new_img = Image.fromarray(new_img_data)
-    new_img_buffer = io.BytesIO()
-    new_img.save(new_img_buffer,format="BMP")
-    new_img.close()
-    new_img_value = new_img_buffer.getvalue()
-    new_img_buffer.close()
-    return new_img_value
-    
\ No newline at end of file
+# Per-thread scratch buffers, reused across requests and grown only when a larger one is needed
+def get_blend_scratch(dtype, size):
+    buffers = getattr(blend_scratch,"buffers",None)
+    if buffers is None:
+        buffers = blend_scratch.buffers = {}
+    scratch = buffers.get(dtype)
+    if scratch is None or scratch[0].size < size:
+        scratch = buffers[dtype] = (np.empty(size,dtype=dtype),np.empty(size,dtype=dtype))
+    return scratch[0][:size], scratch[1][:size]
+
+# Overlay weight of an image that has been blended fetch_count times: repeatedly applying
+# img = (1-RICKROLL_RATE)*img + RICKROLL_RATE*overlay gives (1-RICKROLL_RATE)^n*orig + (1-(1-RICKROLL_RATE)^n)*overlay
+def overlay_rate(fetch_count):
+    return 1-(1-RICKROLL_RATE)**fetch_count
+
+# Fixed-point overlay weight used to render a fetch - fetches whose weights round to the same value
+# render identically (so rendered output can be shared), and all fetches past saturation are the plain overlay
+FRAME_KEY_BITS = 16
+
+def frame_key(fetch_count):
+    return int(round(overlay_rate(fetch_count)*(1 << FRAME_KEY_BITS)))
+
+# Blend overlay into img_data in place: img = (1-rate)*img + rate*overlay, using integer
+# weights that sum to 2^shift (within 1 LSB of the float64 result). 8-bit overlays are widened to 16-bit for
+# uint16 images. Rows are processed in bands so that scratch memory stays bounded regardless of image size.
+def blend_overlay(img_data, overlay_data, rate=RICKROLL_RATE):
+    scratch_dtype, shift = BLEND_TYPES[img_data.dtype]
+    overlay_weight = int(round(rate*(1 << shift)))
+    img_weight = (1 << shift) - overlay_weight
+    if img_data.dtype == np.uint16 and overlay_data.dtype == np.uint8:
+        overlay_weight *= 257
+
+    height = img_data.shape[0]
+    img_rows = img_data.reshape((height,-1))
+    overlay_rows = overlay_data.reshape((height,-1))
+    row_size = img_rows.shape[1]
+    band_rows = max(1,BLEND_SCRATCH_BYTES//(row_size*np.dtype(scratch_dtype).itemsize))
+    band_rows = min(band_rows,height)
+    scratch_img, scratch_overlay = get_blend_scratch(scratch_dtype,band_rows*row_size)
+
+    for start in range(0,height,band_rows):
+        stop = min(start+band_rows,height)
+        size = (stop-start)*row_size
+        band_img = scratch_img[:size].reshape((stop-start,row_size))
+        band_overlay = scratch_overlay[:size].reshape((stop-start,row_size))
+        np.multiply(img_rows[start:stop],img_weight,out=band_img,dtype=scratch_dtype)
+        np.multiply(overlay_rows[start:stop],overlay_weight,out=band_overlay,dtype=scratch_dtype)
+        np.add(band_img,band_overlay,out=band_img)
+        np.right_shift(band_img,shift,out=img_rows[start:stop],casting="unsafe")
+    return img_data
+
+# Decode into a writable array in one of BLEND_MODES - palette and other modes are expanded to RGB(A),
+# 32-bit integer greyscale is narrowed to 16-bit
+def decode_for_blend(img):
+    if img.mode == "I":
+        return np.array(img).clip(0,65535).astype(np.uint16)
+    if img.mode not in BLEND_MODES:
+        has_alpha = "transparency" in img.info or img.mode.endswith("A") or img.mode.endswith("a")
+        converted_img = img.convert("RGBA" if has_alpha else "RGB")
+        img_data = np.array(converted_img)
+        converted_img.close()
+        return img_data
+    return np.array(img)
+
+# Render the image as it looks on its fetch_count-th fetch, directly from the original upload - or from its
+# pixels, if stored in that format (see pixel_format), which are blended in place when the buffer is writable.
+# Seconds spent decoding, getting the overlay and blending are written into timings, if given.
+def render_image(file, fetch_count=1, timings=None):
+    start = time.perf_counter()
+    if is_pixels(file):
+        img_data = decode_pixels(file)
+        if not img_data.flags.writeable:
+            img_data = img_data.copy()
+    else:
+        original_img_buffer = io.BytesIO(file)
+        original_img = Image.open(original_img_buffer)
+        img_data = decode_for_blend(original_img)
+        original_img.close()
+        original_img_buffer.close()
+    decoded = time.perf_counter()
+
+    channels = 1 if img_data.ndim==2 else img_data.shape[2]
+    rickroll_img_data = overlay_cache.get(img_data.shape[1],img_data.shape[0],channels)
+    overlaid = time.perf_counter()
+    blend_overlay(img_data,rickroll_img_data,frame_key(fetch_count)/(1 << FRAME_KEY_BITS))
+    if not timings==None:
+        timings.update({"decode": decoded-start, "overlay": overlaid-decoded, "blend": time.perf_counter()-overlaid})
+    return Image.fromarray(img_data)
+
+# Render and encode in one go
+def apply_shitpost(file, fetch_count=1, codec="png"):
+    new_img = render_image(file,fetch_count)
+    return encode_image(new_img,codec_for_mode(codec,new_img.mode))
+
+# Pixel storage form of an upload, given as bytes or a file object
+def png_to_pixels(file):
+    if not isinstance(file,(bytes,bytearray)):
+        file.seek(0)
+        file = file.read()
+    with Image.open(io.BytesIO(file)) as img:
+        return encode_pixels(decode_for_blend(img))
+
+# Canonical form of an upload - images already in one of BLEND_MODES only lose their ancillary chunks (keeping
+# tRNS, which affects decoding), other modes are re-encoded in the mode they would be blended in
+def normalize_png(file):
+    file_buffer = io.BytesIO(file)
+    with Image.open(file_buffer) as img:
+        if img.mode in BLEND_MODES:
+            return strip_chunks(file,keep=(b"IHDR",b"PLTE",b"tRNS",b"IDAT",b"IEND"))
+        img_data = decode_for_blend(img)
+    normalized_img = Image.fromarray(img_data)
+    normalized_buffer = io.BytesIO()
+    normalized_img.save(normalized_buffer,format="PNG")
+    normalized_img.close()
+    return normalized_buffer.getvalue()
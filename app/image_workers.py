@@ -0,0 +1,226 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+import asyncio
+import io
+import multiprocessing
+import os
+import time
+import traceback
+
+from image_codecs import CODECS, codec_for_mode, record_encode
+from image_utils import render_image
+from overlay_cache import overlay_cache, OVERLAY_CACHE_BUDGET
+from metrics import image_queue_wait_seconds, record_stages, METRICS_ENABLED
+
+# Rendering and encoding run in a pool of IMAGE_WORKERS processes (0 keeps them on the API worker's threadpool),
+# so CPU-heavy fetches use every core without stalling the event loop. Uploads and encoded output are handed
+# over through shared memory rather than pickled through the pool's pipes. Only the worker processes load the
+# overlay - each job reports back its process's overlay cache stats, which are summed for /stats/overlay.
+# At most IMAGE_QUEUE_LIMIT jobs are in flight per API worker, running or queued - beyond that, requests are
+# turned away so clients back off instead of piling up. Jobs taking longer than IMAGE_JOB_TIMEOUT seconds are
+# abandoned; they keep counting against the limit until their process actually finishes them.
+# A worker process dying breaks the whole pool, so it is replaced with a fresh one, and jobs it took down with
+# it are retried once there.
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS",2))
+IMAGE_QUEUE_LIMIT = int(os.environ.get("IMAGE_QUEUE_LIMIT",4*max(IMAGE_WORKERS,1)))
+IMAGE_JOB_TIMEOUT = float(os.environ.get("IMAGE_JOB_TIMEOUT",30))
+IMAGE_RETRY_AFTER = int(os.environ.get("IMAGE_RETRY_AFTER",1))
+
+class Workers_Busy(Exception):
+    pass
+
+class Job_Timeout(Exception):
+    pass
+
+# Worker process setup - decode the overlay source once per process
+def _init_worker():
+    overlay_cache.load()
+
+# Copy bytes into a new shared memory block, returning it
+def _to_shared(data):
+    block = shared_memory.SharedMemory(create=True,size=max(len(data),1))
+    block.buf[:len(data)] = data
+    return block
+
+# Read a shared memory block's contents and free it
+def _take_shared(name, size):
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(block.buf[:size])
+    finally:
+        block.close()
+        block.unlink()
+
+# Runs in a worker process - render the fetch_count-th fetch of the upload in shared memory block input_name,
+# and encode it into a new shared memory block. Returns (output block name, size, codec used, encode seconds,
+# wall clock time the job started, stage timings, process id, overlay cache stats). Stored pixels are blended in place in the input block, and
+# the rendered image may still share its memory, so the block stays open until encoding is done - and every view
+# of it has to be let go of before it can be closed, including those held by the frames of a failed render, so
+# that the render's own error is what gets raised.
+def _render_job(input_name, input_size, fetch_count, codec):
+    started_at = time.time()
+    timings = {}
+    input_block = shared_memory.SharedMemory(name=input_name)
+    try:
+        with input_block.buf[:input_size] as input_view:
+            img = None
+            try:
+                img = render_image(input_view,fetch_count,timings)
+                output_codec = codec_for_mode(codec,img.mode)
+                start = time.perf_counter()
+                buffer = io.BytesIO()
+                img.save(buffer,format=CODECS[output_codec]["format"],**CODECS[output_codec]["params"])
+                encode_seconds = time.perf_counter()-start
+            except BaseException as e:
+                traceback.clear_frames(e.__traceback__)
+                raise
+            finally:
+                if img is not None:
+                    img.close()
+                img = None
+    finally:
+        input_block.close()
+    output_block = _to_shared(buffer.getbuffer())
+    output_block.close()
+    return output_block.name, buffer.tell(), output_codec, encode_seconds, started_at, timings, os.getpid(), overlay_cache.stats()
+
+class Image_Workers:
+    def __init__(self, workers=IMAGE_WORKERS, queue_limit=IMAGE_QUEUE_LIMIT, job_timeout=IMAGE_JOB_TIMEOUT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.job_timeout = job_timeout
+        self.executor = None
+        self.in_flight = 0
+        self.jobs = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.restarts = 0
+        self.job_seconds = 0.0
+        # Latest overlay cache stats of each worker process, by process id
+        self.overlay_snapshots = {}
+
+    @property
+    def enabled(self):
+        return self.executor is not None
+
+    # Start the worker processes and wait until they are ready, so the first fetches do not pay for their
+    # startup. Processes are spawned rather than forked, as the API worker already runs threads.
+    async def start(self):
+        if self.workers <= 0:
+            return
+        self.executor = self._new_executor()
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.executor,time.sleep,0) for _ in range(self.workers)])
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(self.workers,mp_context=multiprocessing.get_context("spawn"),initializer=_init_worker)
+
+    # Replace a pool broken by one of its processes dying - only once, however many of its jobs fail with it
+    def _replace_executor(self, executor):
+        if self.executor is executor:
+            self.restarts += 1
+            self.overlay_snapshots.clear()
+            self.executor = self._new_executor()
+            executor.shutdown(wait=False,cancel_futures=True)
+
+    # Drop queued jobs and wait for running ones, so no worker processes or their semaphores are left behind
+    async def stop(self):
+        if self.executor is not None:
+            executor, self.executor = self.executor, None
+            await asyncio.get_running_loop().run_in_executor(None,lambda: executor.shutdown(wait=True,cancel_futures=True))
+
+    # Render and encode the fetch_count-th fetch of an upload in a worker process, returning (content, codec used).
+    # Raises Workers_Busy if too many jobs are in flight, or Job_Timeout if the job takes too long.
+    async def render(self, file, fetch_count, codec):
+        if self.in_flight >= self.queue_limit:
+            self.rejected += 1
+            raise Workers_Busy()
+        try:
+            return await self._render(file,fetch_count,codec)
+        except BrokenProcessPool:
+            return await self._render(file,fetch_count,codec)
+
+    # One attempt at a render job - raises BrokenProcessPool if the pool broke, after replacing it
+    async def _render(self, file, fetch_count, codec):
+        executor = self.executor
+        self.in_flight += 1
+        start = time.perf_counter()
+        submitted_at = time.time()
+        input_block = _to_shared(file)
+        try:
+            future = executor.submit(_render_job,input_block.name,len(file),fetch_count,codec)
+        except BrokenProcessPool:
+            self.in_flight -= 1
+            input_block.close()
+            input_block.unlink()
+            self._replace_executor(executor)
+            raise
+
+        # The job's output is freed by the request if it is still waiting when the job finishes, otherwise by
+        # the completion callback. Both run on the event loop, so exactly one of them sees the other's flag.
+        state = {"finished": False, "abandoned": False}
+        def free_output(done_future):
+            if not done_future.cancelled() and done_future.exception()==None:
+                _take_shared(done_future.result()[0],0)
+        def finish(done_future):
+            self.in_flight -= 1
+            input_block.close()
+            input_block.unlink()
+            state["finished"] = True
+            if state["abandoned"]:
+                free_output(done_future)
+        loop = asyncio.get_running_loop()
+        future.add_done_callback(lambda done_future: loop.call_soon_threadsafe(finish,done_future))
+
+        try:
+            output_name, output_size, output_codec, encode_seconds, started_at, timings, pid, overlay_stats = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)),self.job_timeout)
+        except BaseException as e:
+            state["abandoned"] = True
+            if state["finished"]:
+                free_output(future)
+            if isinstance(e,asyncio.TimeoutError):
+                self.timeouts += 1
+                raise Job_Timeout()
+            if isinstance(e,BrokenProcessPool):
+                self._replace_executor(executor)
+            if isinstance(e,Exception):
+                self.failures += 1
+            raise
+        content = _take_shared(output_name,output_size)
+        record_encode(output_codec,encode_seconds,output_size)
+        self.overlay_snapshots[pid] = overlay_stats
+        if METRICS_ENABLED:
+            image_queue_wait_seconds.observe(max(started_at-submitted_at,0))
+            record_stages(timings)
+        self.jobs += 1
+        self.job_seconds += time.perf_counter()-start
+        return content, output_codec
+
+    # Overlay cache stats summed over the worker processes, as of their latest jobs - the byte budget applies to
+    # each process separately
+    def overlay_stats(self):
+        snapshots = list(self.overlay_snapshots.values())
+        stats = {i: sum(j[i] for j in snapshots) for i in ("hits","misses","evictions","entries","bytes_used")}
+        stats["byte_budget"] = OVERLAY_CACHE_BUDGET*self.workers
+        stats["pyramid_levels"] = snapshots[0]["pyramid_levels"] if snapshots else []
+        stats["processes"] = len(snapshots)
+        return stats
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queue_limit": self.queue_limit,
+            "job_timeout": self.job_timeout,
+            "in_flight": self.in_flight,
+            "jobs": self.jobs,
+            "mean_job_seconds": self.job_seconds/self.jobs if self.jobs else None,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "failures": self.failures,
+            "restarts": self.restarts
+        }
+
+# Process-wide image worker pool
+image_workers = Image_Workers()
@@ -1,14 +1,34 @@
-from fastapi import FastAPI, Response, File, Form, Depends
-from pydantic import BaseModel, Field
-import redis
-import threading
+from fastapi import FastAPI, Response, File, UploadFile, Form, Depends, Header, Query
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field, conlist
+from contextlib import asynccontextmanager
+import redis.asyncio
+import asyncio
+import contextlib
 import enum
 import random
 import hashlib
 import json
+import os
 import time
 
-from image_utils import check_png, apply_shitpost
+from image_utils import render_image, frame_key
+from image_upload import scan_upload, UPLOAD_MAX_BYTES, UPLOAD_FORM_OVERHEAD
+from png_validator import PNG_Error, PNG_TOO_LARGE_ERR
+from image_codecs import CODECS, negotiate_codec, codec_for_mode, sniff_codec, encode_image, encode_image_chunks, get_codec_stats
+from overlay_cache import overlay_cache
+from contributor_cache import contributor_cache
+from static_assets import static_assets, STATIC_WATCH
+from image_workers import image_workers, Workers_Busy, Job_Timeout, IMAGE_RETRY_AFTER
+from render_cache import render_cache, render_etag, etag_matches, parse_render_etag, parse_byte_range, Range_Not_Satisfiable
+from image_ingest import ingest_worker, INGEST_CONSUMER
+from redis_pool import create_pool, Instrumented_Redis
+from profiler import profiler, Profile_Middleware, Profiler_Busy, is_admin, collapsed_stacks, speedscope_profile, PROFILE_MAX_SECONDS, PROFILE_INTERVAL, ADMIN_ONLY_ERR, PROFILE_BUSY_ERR
+from metrics import Metrics_Middleware, render_metrics, register_stats, record_stages, METRICS_ENABLED, METRICS_MEDIA_TYPE
+import image_store
+import image_ingest
+import contributor_store
 
 # JSON template model for adding new contributors
 class Contributor(BaseModel):
@@ -26,204 +46,457 @@ class SortBy_Options(str,enum.Enum):
     username = "username"
     name = "name"
 
-# Initialize server
-app = FastAPI()
+# Enum for profile output formats
+class Profile_Format(str,enum.Enum):
+    collapsed = "collapsed"
+    speedscope = "speedscope"
+
+# Create the process-wide Redis connection pool, register Lua scripts, load static assets, decode overlay source
+# (unless worker processes render, which decode their own), start image worker processes and start listening for contributor cache invalidations (and static asset changes
+# if watching) once at startup, and stop them and close the pool's connections at shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.redis_pool = create_pool()
+    redis_client = redis.asyncio.Redis(connection_pool=app.state.redis_pool)
+    await image_store.load_scripts(redis_client)
+    await contributor_store.load_scripts(redis_client)
+    await contributor_store.rebuild_indexes(redis_client)
+    static_assets.load()
+    if image_workers.workers <= 0:
+        overlay_cache.load()
+    await image_workers.start()
+    background_tasks = [asyncio.create_task(contributor_cache.listen(redis_client))]
+    if INGEST_CONSUMER:
+        background_tasks.append(asyncio.create_task(ingest_worker.run(redis_client)))
+    if STATIC_WATCH:
+        background_tasks.append(asyncio.create_task(static_assets.watch()))
+    yield
+    for task in background_tasks:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+    await image_workers.stop()
+    await app.state.redis_pool.disconnect()
 
-# Semaphores for contributors/image systems
-contributor_semaphore = threading.Semaphore()
-image_semaphore = threading.Semaphore()
+# Initialize server
+app = FastAPI(lifespan=lifespan)
 
 # Constant strings
-USERS_KEY = "contributors"
-IMG_KEY_PREFIX = "img_"
 USER_NOT_FOUND_ERR = "CONTRIBUTOR_NOT_FOUND"
 UNAUTHORIZED_ERR = "MUST_BE_REGISTERED_CONTRIBUTOR"
 IMG_NOT_FOUND_ERR = "IMAGE_NOT_FOUND"
-WELCOME_HTML = "./perm_contents/welcome.html"
-
-# Get Redis client (connection taken from internal pool, host at "redis")
+INVALID_CURSOR_ERR = "INVALID_CURSOR"
+BATCH_TOO_LARGE_ERR = "BATCH_TOO_LARGE"
+IMG_WORKERS_BUSY_ERR = "IMAGE_WORKERS_BUSY"
+IMG_TIMEOUT_ERR = "IMAGE_PROCESSING_TIMEOUT"
+IMG_NOT_READY_ERR = "IMAGE_NOT_READY"
+WELCOME_HTML = "welcome.html"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+class Upload_Too_Large(Exception):
+    pass
+
+# Turn away image uploads over the size limit - from Content-Length before their body is read, or, for bodies
+# sent without one, as soon as the bytes received pass the limit. The app's own response to the aborted read is
+# dropped in favour of the 413. Plain ASGI middleware, so other responses (streamed ones included) pass through
+# untouched.
+class Upload_Size_Limit:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not (scope["type"]=="http" and scope["method"] in ("POST","PUT") and scope["path"].startswith("/images")):
+            return await self.app(scope,receive,send)
+        limit = UPLOAD_MAX_BYTES+UPLOAD_FORM_OVERHEAD
+        response = Response(content=json.dumps({"error": PNG_TOO_LARGE_ERR}),media_type="application/json",status_code=413)
+        content_length = dict(scope["headers"]).get(b"content-length",b"")
+        if content_length.isdigit() and int(content_length) > limit:
+            return await response(scope,receive,send)
+
+        state = {"received": 0, "too_large": False}
+        async def limited_receive():
+            message = await receive()
+            if message["type"]=="http.request":
+                state["received"] += len(message.get("body",b""))
+                if state["received"] > limit:
+                    state["too_large"] = True
+                    raise Upload_Too_Large()
+            return message
+        async def send_unless_too_large(message):
+            if not state["too_large"]:
+                await send(message)
+        try:
+            await self.app(scope,limited_receive,send_unless_too_large)
+        except Upload_Too_Large:
+            pass
+        if state["too_large"]:
+            await response(scope,receive,send)
+
+app.add_middleware(Upload_Size_Limit)
+app.add_middleware(Profile_Middleware,router=app.router,endpoints=("get_image","get_user_list"))
+# Added last so it is outermost, and times requests turned away by the upload size limit too
+if METRICS_ENABLED:
+    app.add_middleware(Metrics_Middleware)
+
+# Get Redis client backed by the shared pool - connections are only checked out for each command. With metrics
+# on, the client records each command against the request.
 def get_redis_client():
-    return redis.Redis(host="redis")
+    if METRICS_ENABLED:
+        return Instrumented_Redis(connection_pool=app.state.redis_pool)
+    return redis.asyncio.Redis(connection_pool=app.state.redis_pool)
 
 # Welcome page - tested
 @app.get("/")
-def get_root_help_page():
+def get_root_help_page(accept_encoding: str = Header(None), if_none_match: str = Header(None), if_modified_since: str = Header(None)):
     
-    # Open prewritten HTML page and send to client
-    with open(WELCOME_HTML,"r") as f:
-        welcome_message = f.read()
-    return Response(content=welcome_message,media_type="text/html")
+    # Send prewritten HTML page from memory, compressed if the client accepts it
+    asset = static_assets.get(WELCOME_HTML)
+    status, content, headers = asset.serve(accept_encoding,if_none_match,if_modified_since)
+    return Response(content=content,status_code=status,media_type=asset.media_type,headers=headers)
 
 # Add or update user - tested
 @app.post("/contributors")
-def add_user(contributor: Contributor, redis_client: redis.Redis = Depends(get_redis_client)):
+async def add_user(contributor: Contributor, redis_client: redis.asyncio.Redis = Depends(get_redis_client)):
 
-    # Access contributor system semaphore
-    global contributor_semaphore
-
-    # While acquiring semaphore, set user info, checking if new user is created
-    # name and bio strings are joined by ";"
-    contributor_semaphore.acquire()
-    is_new_user = redis_client.hset(USERS_KEY,key=contributor.username,value="{};{}".format(contributor.name,contributor.bio))
-    contributor_semaphore.release()
+    # Set user info, checking if new user is created
+    is_new_user = await contributor_store.set_contributor(redis_client,contributor.username,contributor.name,contributor.bio)
+    contributor_cache.invalidate(contributor.username)
 
     # Return add user result
-    return {"success": True, "new_user_created": is_new_user==1, "path": "/contributors/{}".format(contributor.username)}
+    return {"success": True, "new_user_created": is_new_user, "path": "/contributors/{}".format(contributor.username)}
+
+# Add or update many users in one round trip, reporting for each whether a new user was created
+@app.post("/contributors:batch")
+async def add_users(contributors: conlist(Contributor,min_items=1,max_items=contributor_store.CONTRIBUTOR_BATCH_MAX), redis_client: redis.asyncio.Redis = Depends(get_redis_client)):
+    is_new_user = await contributor_store.set_contributors(redis_client,[(i.username,i.name,i.bio) for i in contributors])
+    for i in contributors:
+        contributor_cache.invalidate(i.username)
+    return {"success": True, "results": [{"username": i.username, "new_user_created": j, "path": "/contributors/{}".format(i.username)} for i, j in zip(contributors,is_new_user)]}
+
+# View many users' details at once - usernames are comma-separated, and unregistered ones get an error entry
+@app.get("/contributors:batch")
+async def get_users(usernames: str, response: Response, redis_client: redis.asyncio.Redis = Depends(get_redis_client)):
+    usernames = [i for i in usernames.split(",") if i]
+    if len(usernames) > contributor_store.CONTRIBUTOR_BATCH_MAX:
+        response.status_code = 400
+        return {"error": BATCH_TOO_LARGE_ERR}
+    found = await contributor_store.get_contributors(redis_client,usernames) if usernames else {}
+    return [{"username": i, **found[i]} if i in found else {"username": i, "error": USER_NOT_FOUND_ERR} for i in usernames]
 
 # View specific user details - tested
 @app.get("/contributors/{username}")
-def get_user(username: str, response: Response, redis_client: redis.Redis = Depends(get_redis_client)):
+async def get_user(username: str, response: Response, redis_client: redis.asyncio.Redis = Depends(get_redis_client)):
 
-    # Get data from hash pair containing dictionary in Redis DB
-    user_data =  redis_client.hget(USERS_KEY,username)
+    # Get data from the contributor cache, which reads through to the Redis DB
+    user_data = await contributor_cache.get(redis_client,username)
 
     # If None was returned, then key doesn't exist in nested dict
-    # Otherwise parse result and return
     if not user_data==None:
-        user_data = user_data.decode()
-        index = user_data.index(";")
-        return {"name": user_data[:index], "bio": user_data[index+1:]}
+        return user_data
     else:
         response.status_code = 404
         return {"error": USER_NOT_FOUND_ERR}        
 
 # Strictly update user - tested
 @app.put("/contributors/{username}")
-def update_user(username: str, contributor_update: Contributor_Update, response: Response, redis_client: redis.Redis = Depends(get_redis_client)):
+async def update_user(username: str, contributor_update: Contributor_Update, response: Response, redis_client: redis.asyncio.Redis = Depends(get_redis_client)):
     
-    # Access contributor system semaphore
-    global contributor_semaphore
-
-    # While locking, check if user exists - if it doesn't return an error, but if it does then perform update
-    contributor_semaphore.acquire()
-    return_data = {"success": True}
-    if redis_client.hexists(USERS_KEY,username):
-        redis_client.hset(USERS_KEY,key=username,value="{};{}".format(contributor_update.name,contributor_update.bio))
-    else:
-        return_data = {"success": False, "error": USER_NOT_FOUND_ERR}
-        response.status_code = 404
-    contributor_semaphore.release()
-    return return_data
+    # Atomically update the user only if it exists - if it doesn't return an error
+    updated = await contributor_store.update_contributor(redis_client,username,contributor_update.name,contributor_update.bio)
+    contributor_cache.invalidate(username)
+    if updated:
+        return {"success": True}
+    response.status_code = 404
+    return {"success": False, "error": USER_NOT_FOUND_ERR}
 
 # Delete user
 @app.delete("/contributors/{username}")
-def delete_user(username:str, response: Response, redis_client: redis.Redis = Depends(get_redis_client)):
-
-    # Acquire contributor system semaphore and delete, checking if any deletion occurred
-    global contributor_semaphore
-    contributor_semaphore.acquire()
-    user_exists = redis_client.hdel(USERS_KEY,username)
-    contributor_semaphore.release()
+async def delete_user(username:str, response: Response, redis_client: redis.asyncio.Redis = Depends(get_redis_client)):
 
-    # If no deletion occurred return an error
-    if user_exists == 1:
+    # Delete, checking if any deletion occurred - if none occurred return an error
+    deleted = await contributor_store.delete_contributor(redis_client,username)
+    contributor_cache.invalidate(username)
+    if deleted:
         return {"success": True}
     else:
         response.status_code = 404
         return {"success": False, "error": USER_NOT_FOUND_ERR}
         
 
+# Encode contributors as NDJSON lines while walking them in batches
+async def export_contributors(redis_client, sort_by):
+    async for contributor in contributor_store.iter_contributors(redis_client,sort_by):
+        yield json.dumps(contributor)+"\n"
+
 # Get list of all users, with query parameters - tested
 @app.get("/contributors")
-def get_user_list(sortBy: SortBy_Options = None, count: int = None, offset: int = 0, redis_client: redis.Redis = Depends(get_redis_client)):
-    
-    # Get list of all users and parse
-    retrieved_data = redis_client.hgetall(USERS_KEY)
-    retrieved_data = {i: retrieved_data[i].decode().split(";") for i in retrieved_data}
-    retrieved_data = [{"username": i, "name": retrieved_data[i][0], "bio": ";".join(retrieved_data[i][1:])} for i in retrieved_data]
-
-    # Perform sorting if needed
-    if not sortBy==None:
-        retrieved_data = sorted(retrieved_data,key=lambda x: x[sortBy])
-    
-    # Process offset and count
-    if not count==None:
-        retrieved_data = retrieved_data[offset:offset+count]
-    else:
-        retrieved_data = retrieved_data[offset:]
+async def get_user_list(response: Response, sortBy: SortBy_Options = None, count: int = Query(None,ge=0), offset: int = Query(0,ge=0), cursor: str = None, accept: str = Header(None), redis_client: redis.asyncio.Redis = Depends(get_redis_client)):
+
+    # Export mode streams every contributor as one JSON line each
+    if not accept==None and NDJSON_MEDIA_TYPE in accept:
+        return StreamingResponse(export_contributors(redis_client,None if sortBy==None else sortBy.value),media_type=NDJSON_MEDIA_TYPE)
     
-    return retrieved_data
+    # Read only the requested page from the sorted index - unsorted listings use username order
+    sort_by = "username" if sortBy==None else sortBy.value
+    if cursor==None:
+        return await contributor_store.get_contributor_page(redis_client,sort_by,offset,count)
+
+    # With a cursor (empty for the first page), resume after the last contributor of the previous page
+    member = None
+    if cursor:
+        member = contributor_store.decode_cursor(sort_by,cursor)
+        if member==None:
+            response.status_code = 400
+            return {"error": INVALID_CURSOR_ERR}
+    if count==0:
+        return {"contributors": [], "next_cursor": cursor}
+    contributors, next_cursor = await contributor_store.get_contributor_page_after(redis_client,sort_by,member,contributor_store.CONTRIBUTOR_PAGE_SIZE if count==None else count,offset)
+    return {"contributors": contributors, "next_cursor": next_cursor}
 
 # Post new image - method cannot be used for update due to generation of new identifiers
 @app.post("/images")
-def post_image(response: Response, file: bytes = File(...), username: str = Form(...), redis_client: redis.Redis = Depends(get_redis_client)):
+async def post_image(response: Response, file: UploadFile = File(...), username: str = Form(...), prefer: str = Header(None), redis_client: redis.asyncio.Redis = Depends(get_redis_client)):
     
     # Check if username exists, if not reject
-    if not redis_client.hexists(USERS_KEY,username):
+    if not await contributor_cache.exists(redis_client,username):
         response.status_code = 401
         return {"error": UNAUTHORIZED_ERR}
 
-    # Verify that the file is a PNG file
-    is_png, error_msg = check_png(file)
-    if not is_png:
+    # With Prefer: respond-async, queue the upload for background ingestion and return straight away -
+    # validation errors are then reported through the status endpoint
+    if not prefer==None and "respond-async" in prefer.lower():
+        identifier = str(time.time()).encode()+str(random.random()).encode()+username.encode()
+        identifier = hashlib.md5(identifier).hexdigest()
+        try:
+            await image_ingest.enqueue(redis_client,identifier,file.file,username)
+        except PNG_Error as e:
+            response.status_code = 400
+            return {"error": e.error}
+        response.status_code = 202
+        response.headers["Location"] = "/images/{}/status".format(identifier)
+        return {"success": True, "path": "/images/{}".format(identifier), "status": "/images/{}/status".format(identifier)}
+
+    # Verify that the file is a PNG file while hashing it, a chunk at a time off the event loop
+    try:
+        digest = await run_in_threadpool(scan_upload,file.file)
+    except PNG_Error as e:
         response.status_code = 400
-        return {"error": error_msg}
+        return {"error": e.error}
     
-    # Create identifier that makes use of RNG and current time
-    identifier = hashlib.md5(file).digest()+str(time.time()).encode()+str(random.random()).encode()
+    # Create identifier that makes use of the content digest, RNG and current time
+    identifier = digest.encode()+str(time.time()).encode()+str(random.random()).encode()
     identifier = hashlib.md5(identifier).hexdigest()
 
-    # Acquire image system semaphore and upload to DB
-    global image_semaphore
-    image_semaphore.acquire()
-    redis_client.set("{}{}".format(IMG_KEY_PREFIX,identifier),file)
-    image_semaphore.release()
+    # Upload to DB atomically - content already stored by another image is not stored again
+    await image_store.store_image(redis_client,identifier,file.file,digest)
 
     return {"success": True, "path": "/images/{}".format(identifier)}
 
 # Strictly update image - works similarly to POST except that no new identifier is generated
 @app.put("/images/{identifier}")
-def update_image(response: Response, identifier: str, file: bytes = File(...), username: str = Form(...), redis_client: redis.Redis = Depends(get_redis_client)):
-    if not redis_client.hexists(USERS_KEY,username):
+async def update_image(response: Response, identifier: str, file: UploadFile = File(...), username: str = Form(...), redis_client: redis.asyncio.Redis = Depends(get_redis_client)):
+    if not await contributor_cache.exists(redis_client,username):
         response.status_code = 401
         return {"error": UNAUTHORIZED_ERR}
-    is_png, error_msg = check_png(file)
-    if not is_png:
+    try:
+        digest = await run_in_threadpool(scan_upload,file.file)
+    except PNG_Error as e:
         response.status_code = 404
-        return {"error": error_msg}
-    global image_semaphore
-    image_semaphore.acquire()
-    return_val = None
-    if redis_client.exists("{}{}".format(IMG_KEY_PREFIX,identifier)):
-        oldfile = redis_client.getset("{}{}".format(IMG_KEY_PREFIX,identifier),file)
-        return_val = {"success": True, "image_changed": not oldfile==file}
-    else:
-        response.status_code = 404
-        return_val = {"error": IMG_NOT_FOUND_ERR}
-    image_semaphore.release()
-    return return_val
+        return {"error": e.error}
+    exists, image_changed = await image_store.replace_image(redis_client,identifier,file.file,digest)
+    if exists:
+        await render_cache.invalidate(redis_client,identifier)
+        return {"success": True, "image_changed": image_changed}
+    response.status_code = 404
+    return {"error": IMG_NOT_FOUND_ERR}
+
+# Ingestion status of an image uploaded with Prefer: respond-async - images stored directly, or whose status
+# has expired, are reported as done
+@app.get("/images/{identifier}/status")
+async def get_image_status(response: Response, identifier: str, redis_client: redis.asyncio.Redis = Depends(get_redis_client)):
+    status = await image_ingest.get_status(redis_client,identifier)
+    if status==None:
+        if not await redis_client.exists(image_store.image_key(identifier)):
+            response.status_code = 404
+            return {"error": IMG_NOT_FOUND_ERR}
+        status = {"state": image_ingest.DONE}
+    return {"path": "/images/{}".format(identifier), **status}
 
 # Delete image
 @app.delete("/images/{identifier}")
-def delete_image(response: Response, identifier: str, redis_client: redis.Redis = Depends(get_redis_client)):
+async def delete_image(response: Response, identifier: str, redis_client: redis.asyncio.Redis = Depends(get_redis_client)):
     
-    # Acquire semaphore and attempt delete
-    global image_semaphore
-    image_semaphore.acquire()
-    exists = redis_client.delete("{}{}".format(IMG_KEY_PREFIX,identifier))
-    image_semaphore.release()
+    # Attempt delete - the existence check and deletion happen in one script
+    exists = await image_store.delete_image(redis_client,identifier)
+    await render_cache.invalidate(redis_client,identifier)
 
     # Check deletion result for whether file existed
-    if exists==1:
+    if exists:
         return {"success": True}
     else:
         response.status_code = 404
         return {"error": IMG_NOT_FOUND_ERR}
 
+# Stream encoded chunks to the client, caching the full output once encoding completes
+async def stream_and_cache(chunks, redis_client, identifier, generation, frame, codec):
+    parts = []
+    async for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    await render_cache.put(redis_client,identifier,generation,frame,codec,b"".join(parts))
+
+# Send a rendered image whole, or the part asked for by a Range header - unless If-Range names a different
+# representation, in which case the whole of this one is sent
+def image_response(content, media_type, headers, range_header=None, if_range=None):
+    if range_header==None or not (if_range==None or if_range.strip()==headers["ETag"]):
+        return Response(content=content,media_type=media_type,headers=headers)
+    try:
+        byte_range = parse_byte_range(range_header,len(content))
+    except Range_Not_Satisfiable:
+        return Response(status_code=416,headers={**headers,"Content-Range": "bytes */{}".format(len(content))})
+    if byte_range==None:
+        return Response(content=content,media_type=media_type,headers=headers)
+    start, end = byte_range
+    headers = {**headers,"Content-Range": "bytes {}-{}/{}".format(start,end,len(content))}
+    return Response(content=content[start:end+1],status_code=206,media_type=media_type,headers=headers)
+
 # Get image
 @app.get("/images/{identifier}")
-def get_image(identifier: str, redis_client: redis.Redis = Depends(get_redis_client)):
-    
-    # Acquire semaphore and get and modify image, then push image back to DB
-    global image_semaphore
-    image_semaphore.acquire()
-    img = redis_client.get("{}{}".format(IMG_KEY_PREFIX,identifier))
-    if img==None:
-        image_semaphore.release()
+async def get_image(identifier: str, accept: str = Header(None), if_none_match: str = Header(None), range_header: str = Header(None,alias="Range"), if_range: str = Header(None), redis_client: redis.asyncio.Redis = Depends(get_redis_client)):
+
+    # Resuming a download - a Range request whose If-Range names a frame of this image that is still cached is
+    # served from that frame, without counting as a new fetch (which would render a different frame)
+    if not range_header==None and not if_range==None:
+        resumed = parse_render_etag(if_range)
+        if not resumed==None and resumed[0]==identifier and resumed[1]==await image_store.get_generation(redis_client,identifier):
+            content = await render_cache.get(redis_client,*resumed)
+            if not content==None:
+                headers = {"ETag": render_etag(*resumed), "Vary": "Accept", "Accept-Ranges": "bytes"}
+                return image_response(content,CODECS[sniff_codec(content)]["media_type"],headers,range_header,if_range)
+
+    # Bump fetch counter - no lock or write-back needed since the N-th fetch is rendered directly from the original
+    fetch_count, generation = await image_store.fetch_image(redis_client,identifier)
+    if fetch_count==None:
+        status = await image_ingest.get_status(redis_client,identifier)
+        if not status==None and status["state"] in (image_ingest.QUEUED,image_ingest.PROCESSING):
+            return Response(content=json.dumps({"error": IMG_NOT_READY_ERR}),media_type="application/json",status_code=404,headers={"Retry-After": str(IMAGE_RETRY_AFTER)})
         return Response(content=json.dumps({"error": IMG_NOT_FOUND_ERR}),media_type="application/json",status_code=404)
-    
-    new_img = apply_shitpost(img)
-    redis_client.set("{}{}".format(IMG_KEY_PREFIX,identifier),new_img)
-    image_semaphore.release()
 
-    return Response(content=new_img,media_type="image/png")
\ No newline at end of file
+    # Clients already holding this exact frame in the negotiated codec get a 304 without any pixel data being touched
+    codec = negotiate_codec(accept)
+    frame = frame_key(fetch_count)
+    headers = {"ETag": render_etag(identifier,generation,frame,codec), "Vary": "Accept", "Accept-Ranges": "bytes"}
+    if etag_matches(if_none_match,headers["ETag"]):
+        render_cache.record_not_modified()
+        return Response(status_code=304,headers=headers)
+
+    # Serve cached render if any
+    new_img = await render_cache.get(redis_client,identifier,generation,frame,codec)
+    if not new_img==None:
+        return image_response(new_img,CODECS[sniff_codec(new_img)]["media_type"],headers,range_header,if_range)
+
+    # Otherwise render from the original
+    img, generation = await image_store.get_original(redis_client,identifier)
+    if img==None:
+        return Response(content=json.dumps({"error": IMG_NOT_FOUND_ERR}),media_type="application/json",status_code=404)
+    headers["ETag"] = render_etag(identifier,generation,frame,codec)
+
+    # In a worker process if the pool is enabled - when it is saturated or the job overruns, ask the client to retry
+    if image_workers.enabled:
+        try:
+            new_img, output_codec = await image_workers.render(img,fetch_count,codec)
+        except (Workers_Busy, Job_Timeout) as e:
+            error = IMG_WORKERS_BUSY_ERR if isinstance(e,Workers_Busy) else IMG_TIMEOUT_ERR
+            return Response(content=json.dumps({"error": error}),media_type="application/json",status_code=503,headers={"Retry-After": str(IMAGE_RETRY_AFTER)})
+        await render_cache.put(redis_client,identifier,generation,frame,codec,new_img)
+        return image_response(new_img,CODECS[output_codec]["media_type"],headers,range_header,if_range)
+
+    # Otherwise in the threadpool, streaming the encoder output as it is produced - range requests need the
+    # total size up front, so their output is collected first
+    timings = {}
+    new_img = await run_in_threadpool(render_image,img,fetch_count,timings)
+    if METRICS_ENABLED:
+        record_stages(timings)
+    output_codec = codec_for_mode(codec,new_img.mode)
+    if not range_header==None:
+        new_img = await run_in_threadpool(encode_image,new_img,output_codec)
+        await render_cache.put(redis_client,identifier,generation,frame,codec,new_img)
+        return image_response(new_img,CODECS[output_codec]["media_type"],headers,range_header,if_range)
+    return StreamingResponse(stream_and_cache(encode_image_chunks(new_img,output_codec),redis_client,identifier,generation,frame,codec),media_type=CODECS[output_codec]["media_type"],headers=headers)
+
+# Overlay cache hit/miss/eviction counters - summed over the worker processes if they render
+@app.get("/stats/overlay")
+def get_overlay_stats():
+    if image_workers.enabled:
+        return image_workers.overlay_stats()
+    return overlay_cache.stats()
+
+# Rendered output cache counters
+@app.get("/stats/render")
+def get_render_stats():
+    return render_cache.stats()
+
+# Per-codec encode latency and output size
+@app.get("/stats/codecs")
+def get_codec_stats_route():
+    return get_codec_stats()
+
+# Contributor cache hit ratio and settings
+@app.get("/stats/contributors")
+def get_contributor_stats():
+    return contributor_cache.stats()
+
+# Image worker pool load, rejections and timeouts
+@app.get("/stats/workers")
+def get_worker_stats():
+    return image_workers.stats()
+
+# Asynchronous ingestion consumer stats for this worker
+@app.get("/stats/ingest")
+def get_ingest_stats():
+    return ingest_worker.stats()
+
+# Image storage deduplication stats
+@app.get("/stats/images")
+async def get_image_stats(redis_client: redis.asyncio.Redis = Depends(get_redis_client)):
+    return await image_store.get_storage_stats(redis_client)
+
+# Redis connection pool utilisation
+@app.get("/stats/redis")
+def get_redis_stats():
+    return app.state.redis_pool.stats()
+
+# Sample where this worker's threads spend their time for the given seconds, returned as collapsed stacks (for
+# flamegraph.pl and the like) or a speedscope file - admins only, and one profile at a time
+@app.get("/debug/profile")
+async def get_profile(seconds: float = Query(10,gt=0,le=PROFILE_MAX_SECONDS), format: Profile_Format = Profile_Format.collapsed, authorization: str = Header(None)):
+    if not is_admin(authorization):
+        return Response(content=json.dumps({"error": ADMIN_ONLY_ERR}),media_type="application/json",status_code=403)
+    try:
+        counts = await profiler.sample(seconds)
+    except Profiler_Busy:
+        return Response(content=json.dumps({"error": PROFILE_BUSY_ERR}),media_type="application/json",status_code=409)
+    if format==Profile_Format.speedscope:
+        content = json.dumps(speedscope_profile(counts,PROFILE_INTERVAL,"worker {}".format(os.getpid())))
+        return Response(content=content,media_type="application/json",headers={"Content-Disposition": 'attachment; filename="profile.speedscope.json"'})
+    return Response(content=collapsed_stacks(counts),media_type="text/plain")
+
+# Profiler usage counters
+@app.get("/stats/profiler")
+def get_profiler_stats():
+    return profiler.stats()
+
+# Prometheus metrics for this worker - request latency, Redis usage, waits and image pipeline stages, plus the
+# counters from the stats routes above
+register_stats("overlay",get_overlay_stats)
+register_stats("render",render_cache.stats)
+register_stats("codecs",get_codec_stats)
+register_stats("contributors",contributor_cache.stats)
+register_stats("workers",image_workers.stats)
+register_stats("ingest",ingest_worker.stats)
+register_stats("profiler",profiler.stats)
+register_stats("redis_pool",lambda: app.state.redis_pool.stats())
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(content=render_metrics(),media_type=METRICS_MEDIA_TYPE)
@@ -0,0 +1,159 @@
+from bisect import bisect_left
+import contextvars
+import os
+import time
+
+# Per-worker metrics in the Prometheus text format, served on /metrics - request latency per route, Redis
+# commands and round trip time (overall per command, and per request through the client from
+# get_redis_client), waits for a Redis connection or an image worker, and image pipeline stage timings.
+# The stats() of the caches and pools are exported alongside as untyped samples. Metrics are plain counters
+# updated from the event loop, so recording costs a few additions - METRICS_ENABLED=0 turns it all off.
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED","1")=="1"
+LATENCY_BUCKETS = (0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10)
+COUNT_BUCKETS = (0,1,2,4,8,16,32,64,128)
+METRICS_MEDIA_TYPE = "text/plain; version=0.0.4"
+
+# Redis usage of the request being handled, as [commands, seconds]
+request_redis = contextvars.ContextVar("request_redis",default=None)
+
+def escape_label(value):
+    return str(value).replace("\\","\\\\").replace('"','\\"').replace("\n","\\n")
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{"+",".join('{}="{}"'.format(i,escape_label(j)) for i, j in zip(names,values))+"}"
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value,float) else str(value)
+
+class Counter:
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.series = {}
+
+    def inc(self, *label_values, amount=1):
+        self.series[label_values] = self.series.get(label_values,0)+amount
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name,self.description),"# TYPE {} counter".format(self.name)]
+        for label_values, value in sorted(self.series.items()):
+            lines.append("{}{} {}".format(self.name,format_labels(self.labels,label_values),format_value(value)))
+        return lines
+
+# Bucket counts are kept per bucket and only made cumulative when rendered
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0]*(len(self.buckets)+1),0.0,0]
+        series[0][bisect_left(self.buckets,value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name,self.description),"# TYPE {} histogram".format(self.name)]
+        for label_values, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets+("+Inf",),counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labels+("le",),label_values+(bound if bound=="+Inf" else format_value(float(bound)),))
+                lines.append("{}_bucket{} {}".format(self.name,labels,cumulative))
+            lines.append("{}_sum{} {}".format(self.name,format_labels(self.labels,label_values),repr(total)))
+            lines.append("{}_count{} {}".format(self.name,format_labels(self.labels,label_values),count))
+        return lines
+
+http_requests = Counter("http_requests_total","HTTP requests handled",("method","route","status"))
+http_request_seconds = Histogram("http_request_duration_seconds","Time to handle an HTTP request, including streaming the body",("method","route"))
+redis_commands = Counter("redis_commands_total","Redis commands sent",("command",))
+redis_command_seconds = Histogram("redis_command_duration_seconds","Redis round trip time, per command or pipeline",("command",))
+request_redis_commands = Histogram("http_request_redis_commands","Redis commands sent while handling a request",("route",),COUNT_BUCKETS)
+request_redis_seconds = Histogram("http_request_redis_seconds","Time spent waiting on Redis while handling a request",("route",))
+redis_pool_wait_seconds = Histogram("redis_pool_wait_seconds","Time spent waiting for a pooled Redis connection")
+image_queue_wait_seconds = Histogram("image_worker_queue_wait_seconds","Time image jobs spent queued before a worker process picked them up")
+image_stage_seconds = Histogram("image_render_stage_seconds","Time spent in each image pipeline stage",("stage",))
+
+METRICS = [http_requests,http_request_seconds,redis_commands,redis_command_seconds,request_redis_commands,request_redis_seconds,redis_pool_wait_seconds,image_queue_wait_seconds,image_stage_seconds]
+
+# Stats exported as untyped samples - name -> function returning a stats dict, whose numeric values become
+# samples (nested dicts, like per-codec stats, get the outer key as a "key" label)
+STATS_SOURCES = {}
+
+def register_stats(name, stats):
+    STATS_SOURCES[name] = stats
+
+def render_stats(name, stats):
+    samples = {}
+    for field, value in stats.items():
+        if isinstance(value,dict):
+            for inner_field, inner_value in value.items():
+                samples.setdefault("app_{}_{}".format(name,inner_field),[]).append((format_labels(("key",),(field,)),inner_value))
+        else:
+            samples.setdefault("app_{}_{}".format(name,field),[]).append(("",value))
+    # Samples of a metric have to be listed together, under its TYPE line
+    lines = []
+    for metric_name, metric_samples in samples.items():
+        metric_samples = [(i,int(j) if isinstance(j,bool) else j) for i, j in metric_samples if isinstance(j,(int,float))]
+        if metric_samples:
+            lines.append("# TYPE {} untyped".format(metric_name))
+            lines += ["{}{} {}".format(metric_name,i,format_value(j)) for i, j in metric_samples]
+    return lines
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    for name, stats in STATS_SOURCES.items():
+        lines += render_stats(name,stats())
+    return "\n".join(lines)+"\n"
+
+# Record one Redis round trip carrying the given command names, against the current request if any
+def record_redis(commands, seconds, name=None):
+    for command in commands:
+        redis_commands.inc(command)
+    redis_command_seconds.observe(seconds,name or commands[0])
+    usage = request_redis.get()
+    if usage is not None:
+        usage[0] += len(commands)
+        usage[1] += seconds
+
+def record_stages(timings):
+    for stage, seconds in timings.items():
+        image_stage_seconds.observe(seconds,stage)
+
+# Plain ASGI middleware timing each HTTP request by its route template (so identifiers in paths do not create
+# new series), and collecting the request's Redis usage
+class Metrics_Middleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not scope["type"]=="http":
+            return await self.app(scope,receive,send)
+        start = time.perf_counter()
+        status = [500]
+        usage = [0,0.0]
+        token = request_redis.set(usage)
+        async def send_with_status(message):
+            if message["type"]=="http.response.start":
+                status[0] = message["status"]
+            await send(message)
+        try:
+            await self.app(scope,receive,send_with_status)
+        finally:
+            request_redis.reset(token)
+            route = scope.get("route")
+            route = "unmatched" if route is None else route.path
+            http_requests.inc(scope["method"],route,str(status[0]))
+            http_request_seconds.observe(time.perf_counter()-start,scope["method"],route)
+            request_redis_commands.observe(usage[0],route)
+            request_redis_seconds.observe(usage[1],route)
@@ -0,0 +1,17 @@
+import asyncio
+
+from image_store import migrate_legacy_images, chunk_legacy_blobs
+from redis_pool import create_pool
+import redis.asyncio
+
+async def main():
+    redis_client = redis.asyncio.Redis(connection_pool=create_pool())
+    print("Migrated {} images".format(await migrate_legacy_images(redis_client)))
+    print("Chunked {} blobs".format(await chunk_legacy_blobs(redis_client)))
+    await redis_client.aclose()
+
+# One-off migration of img_* keys written before fetch counters and content-addressed blobs were introduced,
+# and of blobs written before they were chunked
+# Run inside the app container with: python migrate_images.py
+if __name__=="__main__":
+    asyncio.run(main())
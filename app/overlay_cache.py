@@ -0,0 +1,104 @@
+from collections import OrderedDict
+from PIL import Image
+import numpy as np
+import threading
+import os
+
+RICKROLL_FILE = "./perm_contents/rickroll_4k.png"
+
+# Byte budget for resized overlays kept in memory, and smallest pyramid level edge
+OVERLAY_CACHE_BUDGET = int(os.environ.get("OVERLAY_CACHE_BUDGET",64*1024*1024))
+PYRAMID_MIN_EDGE = 16
+
+# Cache of the rickroll overlay - the source is decoded once into a mip pyramid (each level half
+# the size of the previous one), and resized overlays are kept in an LRU keyed by (width, height, channels)
+class Overlay_Cache:
+    def __init__(self, source_file=RICKROLL_FILE, byte_budget=OVERLAY_CACHE_BUDGET):
+        self.source_file = source_file
+        self.byte_budget = byte_budget
+        self.pyramid = None
+        self.entries = OrderedDict()
+        self.bytes_used = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Decode source image and build pyramid - safe to call more than once
+    def load(self):
+        with self.lock:
+            if self.pyramid is not None:
+                return
+            with Image.open(self.source_file) as source_img:
+                level = source_img.convert("RGB")
+            pyramid = [level]
+            while min(level.size)//2 >= PYRAMID_MIN_EDGE:
+                level = level.reduce(2)
+                pyramid.append(level)
+            self.pyramid = pyramid
+
+    # Pick the smallest pyramid level that is still at least as large as the target in both dimensions
+    def _nearest_level(self, width, height):
+        chosen = self.pyramid[0]
+        for level in self.pyramid:
+            if level.size[0] < width or level.size[1] < height:
+                break
+            chosen = level
+        return chosen
+
+    # Resize from the nearest level and match the requested channel count (1=L, 2=LA, 3=RGB, 4=RGBA),
+    # with any added alpha channel set fully opaque
+    def _render(self, width, height, channels):
+        resized_img = self._nearest_level(width,height).resize((width,height))
+        if channels <= 2:
+            resized_img = resized_img.convert("L")
+        resized_data = np.asarray(resized_img)
+        resized_img.close()
+        if channels in (2,4):
+            overlay_data = np.empty((height,width,channels),dtype=np.uint8)
+            overlay_data[:,:,:channels-1] = resized_data.reshape((height,width,channels-1))
+            overlay_data[:,:,channels-1] = 255
+        else:
+            overlay_data = np.array(resized_data)
+        overlay_data.setflags(write=False)
+        return overlay_data
+
+    # Get read-only overlay array of shape (height, width) for 1 channel, else (height, width, channels)
+    def get(self, width, height, channels):
+        if self.pyramid is None:
+            self.load()
+        key = (width,height,channels)
+        with self.lock:
+            overlay_data = self.entries.get(key)
+            if overlay_data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return overlay_data
+            self.misses += 1
+
+        # Resize outside of the lock so that other sizes are not held up
+        overlay_data = self._render(width,height,channels)
+        with self.lock:
+            if key not in self.entries and overlay_data.nbytes <= self.byte_budget:
+                self.entries[key] = overlay_data
+                self.bytes_used += overlay_data.nbytes
+                while self.bytes_used > self.byte_budget:
+                    _, evicted_data = self.entries.popitem(last=False)
+                    self.bytes_used -= evicted_data.nbytes
+                    self.evictions += 1
+        return overlay_data
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes_used": self.bytes_used,
+                "byte_budget": self.byte_budget,
+                "pyramid_levels": [] if self.pyramid is None else [list(i.size) for i in self.pyramid]
+            }
+
+# Process-wide overlay cache
+overlay_cache = Overlay_Cache()
@@ -0,0 +1,30 @@
+import struct
+import numpy as np
+
+# Raw pixel storage format - a fixed 32-byte header (magic, mode, numpy dtype, width, height, channels) followed
+# by the pixel array as it is blended, row-major with channels interleaved. Reading it back is np.frombuffer
+# over the stored bytes, so no decoding or copying is needed before blending.
+PIXEL_MAGIC = b"PXL1"
+PIXEL_HEADER = struct.Struct("<4s8s4sIIB7x")
+MODES_BY_CHANNELS = {1: "L", 2: "LA", 3: "RGB", 4: "RGBA"}
+
+def is_pixels(file):
+    return bytes(file[:len(PIXEL_MAGIC)])==PIXEL_MAGIC
+
+# Serialise an array in one of the blend modes (uint8 L/LA/RGB/RGBA, or uint16 I;16)
+def encode_pixels(img_data):
+    height, width = img_data.shape[:2]
+    channels = 1 if img_data.ndim==2 else img_data.shape[2]
+    mode = "I;16" if img_data.dtype==np.uint16 else MODES_BY_CHANNELS[channels]
+    img_data = np.ascontiguousarray(img_data,dtype=img_data.dtype.newbyteorder("<"))
+    header = PIXEL_HEADER.pack(PIXEL_MAGIC,mode.encode(),img_data.dtype.str.encode(),width,height,channels)
+    return b"".join((header,memoryview(img_data).cast("B")))
+
+# Array of serialised pixels, viewing the buffer without copying - the array is only writable if the buffer is
+# (a bytearray or writable memoryview rather than bytes). The stored mode is implied by the array's shape and
+# dtype.
+def decode_pixels(file):
+    _, _, dtype, width, height, channels = PIXEL_HEADER.unpack_from(file)
+    shape = (height,width) if channels==1 else (height,width,channels)
+    img_data = np.frombuffer(file,dtype=np.dtype(dtype.rstrip(b"\0").decode()),count=width*height*channels,offset=PIXEL_HEADER.size)
+    return img_data.reshape(shape)
@@ -0,0 +1,202 @@
+import os
+import struct
+import zlib
+
+# Streaming PNG validation at the chunk level - checks signature, IHDR, CRCs and chunk ordering, and
+# enforces size limits from the header alone, without inflating or decoding any pixel data.
+# Data can be fed in pieces of any size, and only the current chunk header plus IHDR/PLTE are kept in memory.
+PNG_HEADER = bytes.fromhex("89504E470D0A1A0A")
+PNG_MAX_DIMENSION = int(os.environ.get("PNG_MAX_DIMENSION",16384))
+PNG_MAX_PIXELS = int(os.environ.get("PNG_MAX_PIXELS",8192*8192))
+PNG_MAX_DECOMPRESSED_BYTES = int(os.environ.get("PNG_MAX_DECOMPRESSED_BYTES",512*1024*1024))
+
+NOT_PNG_ERR = "NOT_PNG_FILE"
+BAD_PNG_ERR = "BAD_PNG_FILE"
+PNG_TOO_LARGE_ERR = "PNG_TOO_LARGE"
+
+# Allowed bit depths and channel count per colour type
+COLOR_TYPES = {0: ((1,2,4,8,16),1), 2: ((8,16),3), 3: ((1,2,4,8),1), 4: ((8,16),2), 6: ((8,16),4)}
+CRITICAL_CHUNKS = (b"IHDR",b"PLTE",b"IDAT",b"IEND")
+BEFORE_PLTE_CHUNKS = (b"cHRM",b"gAMA",b"iCCP",b"sBIT",b"sRGB")
+AFTER_PLTE_CHUNKS = (b"bKGD",b"hIST",b"tRNS")
+BEFORE_IDAT_CHUNKS = BEFORE_PLTE_CHUNKS+AFTER_PLTE_CHUNKS+(b"pHYs",b"sPLT",b"acTL")
+ADAM7_PASSES = ((0,0,8,8),(4,0,8,8),(0,4,4,8),(2,0,4,4),(0,2,2,4),(1,0,2,2),(0,1,1,2))
+
+class PNG_Error(Exception):
+    def __init__(self, error):
+        super().__init__(error)
+        self.error = error
+
+# Size of the zlib stream once inflated, including the filter byte that starts each row (and each
+# Adam7 pass row for interlaced images)
+def decompressed_size(width, height, bit_depth, channels, interlaced):
+    bits_per_pixel = bit_depth*channels
+    if not interlaced:
+        return height*(1+(width*bits_per_pixel+7)//8)
+    total = 0
+    for x_start, y_start, x_step, y_step in ADAM7_PASSES:
+        pass_width = (width-x_start+x_step-1)//x_step
+        pass_height = (height-y_start+y_step-1)//y_step
+        if pass_width > 0 and pass_height > 0:
+            total += pass_height*(1+(pass_width*bits_per_pixel+7)//8)
+    return total
+
+class PNG_Validator:
+    def __init__(self, max_dimension=PNG_MAX_DIMENSION, max_pixels=PNG_MAX_PIXELS, max_decompressed=PNG_MAX_DECOMPRESSED_BYTES):
+        self.max_dimension = max_dimension
+        self.max_pixels = max_pixels
+        self.max_decompressed = max_decompressed
+        self.pending = b""
+        self.signature_checked = False
+        self.chunk_type = None
+        self.chunk_remaining = 0
+        self.chunk_crc = 0
+        self.chunk_data = None
+        self.seen = set()
+        self.previous_type = None
+        self.header = None
+        self.error = None
+
+    # Feed the next piece of the file - raises PNG_Error as soon as it is known to be invalid
+    def feed(self, data):
+        if self.error is not None:
+            raise PNG_Error(self.error)
+        try:
+            self._feed(memoryview(data))
+        except PNG_Error as e:
+            self.error = e.error
+            raise
+
+    def _feed(self, data):
+        while len(data) > 0:
+            if not self.signature_checked:
+                data = self._take(data,len(PNG_HEADER))
+                if len(self.pending)==len(PNG_HEADER):
+                    if not self.pending==PNG_HEADER:
+                        raise PNG_Error(NOT_PNG_ERR)
+                    self.signature_checked = True
+                    self.pending = b""
+            elif b"IEND" in self.seen:
+                raise PNG_Error(BAD_PNG_ERR)
+            elif self.chunk_type is None:
+                data = self._take(data,8)
+                if len(self.pending)==8:
+                    self._start_chunk(self.pending)
+                    self.pending = b""
+            elif self.chunk_remaining > 0:
+                piece = data[:self.chunk_remaining]
+                data = data[len(piece):]
+                self.chunk_crc = zlib.crc32(piece,self.chunk_crc)
+                self.chunk_remaining -= len(piece)
+                if self.chunk_data is not None:
+                    self.chunk_data += piece
+            else:
+                data = self._take(data,4)
+                if len(self.pending)==4:
+                    if not struct.unpack(">I",self.pending)[0]==self.chunk_crc:
+                        raise PNG_Error(BAD_PNG_ERR)
+                    self.pending = b""
+                    self._end_chunk()
+
+    # Accumulate up to size bytes into pending, returning the rest of data
+    def _take(self, data, size):
+        needed = size-len(self.pending)
+        self.pending += bytes(data[:needed])
+        return data[needed:]
+
+    def _start_chunk(self, chunk_header):
+        length, chunk_type = struct.unpack(">I4s",chunk_header)
+        if length > 0x7FFFFFFF or not chunk_type.isalpha():
+            raise PNG_Error(BAD_PNG_ERR)
+        if self.header is None and not chunk_type==b"IHDR":
+            raise PNG_Error(BAD_PNG_ERR)
+        if (chunk_type==b"IHDR" and not length==13) or (chunk_type==b"PLTE" and length > 768):
+            raise PNG_Error(BAD_PNG_ERR)
+
+        # Critical chunks must be known, and appear in order with IDAT chunks consecutive
+        is_critical = chunk_type[0:1].isupper()
+        if is_critical and chunk_type not in CRITICAL_CHUNKS:
+            raise PNG_Error(BAD_PNG_ERR)
+        if chunk_type in (b"IHDR",b"PLTE") and chunk_type in self.seen:
+            raise PNG_Error(BAD_PNG_ERR)
+        if chunk_type==b"IDAT" and b"IDAT" in self.seen and not self.previous_type==b"IDAT":
+            raise PNG_Error(BAD_PNG_ERR)
+        if chunk_type==b"PLTE" and (b"IDAT" in self.seen or self.header["color_type"] in (0,4)):
+            raise PNG_Error(BAD_PNG_ERR)
+        if chunk_type in BEFORE_IDAT_CHUNKS and b"IDAT" in self.seen:
+            raise PNG_Error(BAD_PNG_ERR)
+        if chunk_type in BEFORE_PLTE_CHUNKS and b"PLTE" in self.seen:
+            raise PNG_Error(BAD_PNG_ERR)
+        if chunk_type==b"IDAT" and self.header["color_type"]==3 and b"PLTE" not in self.seen:
+            raise PNG_Error(BAD_PNG_ERR)
+        if chunk_type==b"IEND" and (not length==0 or b"IDAT" not in self.seen):
+            raise PNG_Error(BAD_PNG_ERR)
+
+        self.chunk_type = chunk_type
+        self.chunk_remaining = length
+        self.chunk_crc = zlib.crc32(chunk_type)
+        self.chunk_data = b"" if chunk_type in (b"IHDR",b"PLTE") else None
+
+    def _end_chunk(self):
+        if self.chunk_type==b"IHDR":
+            self._check_header(self.chunk_data)
+        elif self.chunk_type==b"PLTE":
+            entries, remainder = divmod(len(self.chunk_data),3)
+            max_entries = 1 << self.header["bit_depth"] if self.header["color_type"]==3 else 256
+            if not remainder==0 or entries==0 or entries > min(256,max_entries):
+                raise PNG_Error(BAD_PNG_ERR)
+        self.seen.add(self.chunk_type)
+        self.previous_type = self.chunk_type
+        self.chunk_type = None
+        self.chunk_data = None
+
+    # Validate IHDR fields and enforce the size limits
+    def _check_header(self, data):
+        if not len(data)==13:
+            raise PNG_Error(BAD_PNG_ERR)
+        width, height, bit_depth, color_type, compression, filter_method, interlace = struct.unpack(">IIBBBBB",data)
+        if width==0 or height==0 or width > 0x7FFFFFFF or height > 0x7FFFFFFF:
+            raise PNG_Error(BAD_PNG_ERR)
+        if color_type not in COLOR_TYPES or bit_depth not in COLOR_TYPES[color_type][0]:
+            raise PNG_Error(BAD_PNG_ERR)
+        if not compression==0 or not filter_method==0 or interlace not in (0,1):
+            raise PNG_Error(BAD_PNG_ERR)
+        channels = COLOR_TYPES[color_type][1]
+        if width > self.max_dimension or height > self.max_dimension or width*height > self.max_pixels:
+            raise PNG_Error(PNG_TOO_LARGE_ERR)
+        if decompressed_size(width,height,bit_depth,channels,interlace==1) > self.max_decompressed:
+            raise PNG_Error(PNG_TOO_LARGE_ERR)
+        self.header = {"width": width, "height": height, "bit_depth": bit_depth, "color_type": color_type, "interlaced": interlace==1}
+
+    # Signal end of file - raises PNG_Error if the file stopped before IEND
+    def finish(self):
+        if self.error is not None:
+            raise PNG_Error(self.error)
+        if not self.signature_checked:
+            self.error = NOT_PNG_ERR
+            raise PNG_Error(self.error)
+        if b"IEND" not in self.seen:
+            self.error = BAD_PNG_ERR
+            raise PNG_Error(self.error)
+        return self.header
+
+# Validate a complete file, returning (True, header) or (False, error string)
+def validate_png(file, **limits):
+    validator = PNG_Validator(**limits)
+    try:
+        validator.feed(file)
+        return True, validator.finish()
+    except PNG_Error as e:
+        return False, e.error
+
+# Rebuild an already validated PNG from its chunks of the given types only, dropping everything else
+def strip_chunks(file, keep=CRITICAL_CHUNKS):
+    parts = [PNG_HEADER]
+    position = len(PNG_HEADER)
+    while position < len(file):
+        length, chunk_type = struct.unpack_from(">I4s",file,position)
+        end = position+12+length
+        if chunk_type in keep:
+            parts.append(file[position:end])
+        position = end
+    return b"".join(parts)
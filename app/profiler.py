@@ -0,0 +1,180 @@
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+from starlette.routing import Match
+import cProfile
+import io
+import json
+import os
+import pstats
+import secrets
+import sys
+import threading
+import time
+
+# On-demand profiling of a live API worker, for admins only - requests must carry "Authorization: Bearer
+# <DEBUG_TOKEN>", and with DEBUG_TOKEN unset profiling is off entirely. Only one profile runs at a time per
+# worker.
+# /debug/profile samples the stacks of every thread in the worker every PROFILE_INTERVAL seconds from a
+# background thread, which costs the profiled code nothing beyond the GIL hand-offs. Image worker processes
+# are separate processes, so they are not sampled.
+# A request to a profiled route with "X-Profile: 1" runs under cProfile instead, and gets the profile stats
+# back in place of its response. cProfile only sees the event loop thread (work handed to the threadpool shows
+# up as the wait for it), and every other request interleaved on the loop meanwhile.
+DEBUG_TOKEN = os.environ.get("DEBUG_TOKEN")
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL",0.01))
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS",60))
+PROFILE_STATS_LINES = 50
+
+ADMIN_ONLY_ERR = "ADMIN_ONLY"
+PROFILE_BUSY_ERR = "PROFILE_IN_PROGRESS"
+
+class Profiler_Busy(Exception):
+    pass
+
+def is_admin(authorization):
+    if DEBUG_TOKEN==None or authorization==None:
+        return False
+    scheme, _, token = authorization.partition(" ")
+    return scheme.lower()=="bearer" and secrets.compare_digest(token.strip().encode(),DEBUG_TOKEN.encode())
+
+# Stack of a frame as (function, file, first line) tuples, outermost first, under a root frame for its thread
+def _stack(frame, thread_name):
+    stack = []
+    while not frame==None:
+        code = frame.f_code
+        stack.append((code.co_name,code.co_filename,code.co_firstlineno))
+        frame = frame.f_back
+    stack.append((thread_name,"",0))
+    return tuple(reversed(stack))
+
+def _frame_name(frame):
+    name, filename, line = frame
+    return name if not filename else "{} ({}:{})".format(name,filename,line)
+
+# Sampled stacks in collapsed form, one "frame;frame;frame count" line per distinct stack
+def collapsed_stacks(counts):
+    return "".join("{} {}\n".format(";".join(_frame_name(i).replace(";",":") for i in stack),count) for stack, count in sorted(counts.items()))
+
+# Sampled stacks as a speedscope file (https://www.speedscope.app), weighted by sampled seconds
+def speedscope_profile(counts, interval, name):
+    frames = {}
+    samples = []
+    weights = []
+    for stack, count in counts.items():
+        samples.append([frames.setdefault(i,len(frames)) for i in stack])
+        weights.append(count*interval)
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "shared": {"frames": [{"name": i[0], "file": i[1], "line": i[2]} if i[1] else {"name": i[0]} for i in frames]},
+        "profiles": [{"type": "sampled", "name": name, "unit": "seconds", "startValue": 0, "endValue": sum(weights), "samples": samples, "weights": weights}],
+        "name": name,
+        "exporter": "50.012_Lab2 profiler"
+    }
+
+class Profiler:
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.busy = False
+        self.samplings = 0
+        self.requests_profiled = 0
+        self.rejected = 0
+
+    # Runs in a background thread - sample every other thread's stack until seconds are up, returning the
+    # number of times each distinct stack was seen
+    def _sample(self, seconds):
+        own_thread = threading.get_ident()
+        thread_names = {}
+        counts = {}
+        end = time.perf_counter()+seconds
+        while time.perf_counter() < end:
+            frames = sys._current_frames()
+            if not frames.keys() <= thread_names.keys():
+                thread_names = {i.ident: i.name for i in threading.enumerate()}
+            for thread_id, frame in frames.items():
+                if not thread_id==own_thread:
+                    stack = _stack(frame,thread_names.get(thread_id,str(thread_id)))
+                    counts[stack] = counts.get(stack,0)+1
+            # Frames keep their locals alive, so they are not held on to while sleeping
+            frames = frame = None
+            time.sleep(self.interval)
+        return counts
+
+    def _acquire(self):
+        if self.busy:
+            self.rejected += 1
+            raise Profiler_Busy()
+        self.busy = True
+
+    # Sample the worker's threads for the given seconds - raises Profiler_Busy if a profile is already running
+    async def sample(self, seconds):
+        self._acquire()
+        try:
+            counts = await run_in_threadpool(self._sample,seconds)
+        finally:
+            self.busy = False
+        self.samplings += 1
+        return counts
+
+    # Run a request through an ASGI app under cProfile, discarding its response body, and return the profile
+    # stats as text, sorted by cumulative time, with the status the request would have got - raises
+    # Profiler_Busy if a profile is already running
+    async def profile_request(self, app, scope, receive):
+        self._acquire()
+        status = [None]
+        async def discard(message):
+            if message["type"]=="http.response.start":
+                status[0] = message["status"]
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                await app(scope,receive,discard)
+            finally:
+                profile.disable()
+        finally:
+            self.busy = False
+        self.requests_profiled += 1
+        output = io.StringIO()
+        pstats.Stats(profile,stream=output).sort_stats("cumulative").print_stats(PROFILE_STATS_LINES)
+        return output.getvalue(), status[0]
+
+    def stats(self):
+        return {
+            "enabled": not DEBUG_TOKEN==None,
+            "busy": self.busy,
+            "interval": self.interval,
+            "samplings": self.samplings,
+            "requests_profiled": self.requests_profiled,
+            "rejected": self.rejected
+        }
+
+# Process-wide profiler
+profiler = Profiler()
+
+# Plain ASGI middleware profiling admin requests with "X-Profile: 1" to the routes of the given endpoint names
+# on router - other requests pass through untouched
+class Profile_Middleware:
+    def __init__(self, app, router, endpoints):
+        self.app = app
+        self.router = router
+        self.endpoints = endpoints
+
+    def _profiled_route(self, scope):
+        return any(i.name in self.endpoints and i.matches(scope)[0]==Match.FULL for i in self.router.routes)
+
+    async def __call__(self, scope, receive, send):
+        if not scope["type"]=="http":
+            return await self.app(scope,receive,send)
+        headers = dict(scope["headers"])
+        if not headers.get(b"x-profile")==b"1" or not self._profiled_route(scope):
+            return await self.app(scope,receive,send)
+        if not is_admin(headers.get(b"authorization",b"").decode("latin-1") or None):
+            response = Response(content=json.dumps({"error": ADMIN_ONLY_ERR}),media_type="application/json",status_code=403)
+            return await response(scope,receive,send)
+        try:
+            output, status = await profiler.profile_request(self.app,scope,receive)
+        except Profiler_Busy:
+            response = Response(content=json.dumps({"error": PROFILE_BUSY_ERR}),media_type="application/json",status_code=409)
+            return await response(scope,receive,send)
+        response = Response(content=output,media_type="text/plain",headers={"X-Profile-Status": str(status)})
+        await response(scope,receive,send)
@@ -0,0 +1,98 @@
+import os
+import time
+import redis.asyncio
+import redis.asyncio.client
+
+from metrics import record_redis, redis_pool_wait_seconds, METRICS_ENABLED
+
+# Connection settings for the process-wide Redis pool - REDIS_UNIX_SOCKET takes precedence over host/port
+REDIS_HOST = os.environ.get("REDIS_HOST","redis")
+REDIS_PORT = int(os.environ.get("REDIS_PORT",6379))
+REDIS_UNIX_SOCKET = os.environ.get("REDIS_UNIX_SOCKET")
+REDIS_POOL_SIZE = int(os.environ.get("REDIS_POOL_SIZE",50))
+REDIS_POOL_TIMEOUT = float(os.environ.get("REDIS_POOL_TIMEOUT",5))
+REDIS_SOCKET_TIMEOUT = float(os.environ.get("REDIS_SOCKET_TIMEOUT",5))
+REDIS_CONNECT_TIMEOUT = float(os.environ.get("REDIS_CONNECT_TIMEOUT",2))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.environ.get("REDIS_HEALTH_CHECK_INTERVAL",30))
+
+# Blocking pool that waits up to REDIS_POOL_TIMEOUT for a free connection instead of erroring,
+# and keeps utilisation counters
+class Instrumented_Connection_Pool(redis.asyncio.BlockingConnectionPool):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.acquisitions = 0
+        self.acquire_seconds = 0.0
+        self.acquire_timeouts = 0
+
+    async def get_connection(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            connection = await super().get_connection(*args,**kwargs)
+        except redis.ConnectionError:
+            self.acquire_timeouts += 1
+            raise
+        wait_seconds = time.perf_counter()-start
+        self.acquire_seconds += wait_seconds
+        if METRICS_ENABLED:
+            redis_pool_wait_seconds.observe(wait_seconds)
+        self.acquisitions += 1
+        self.in_use += 1
+        self.peak_in_use = max(self.peak_in_use,self.in_use)
+        return connection
+
+    async def release(self, connection):
+        self.in_use -= 1
+        await super().release(connection)
+
+    def stats(self):
+        return {
+            "max_connections": self.max_connections,
+            "in_use": self.in_use,
+            "peak_in_use": self.peak_in_use,
+            "utilisation": self.in_use/self.max_connections,
+            "acquisitions": self.acquisitions,
+            "mean_acquire_seconds": self.acquire_seconds/self.acquisitions if self.acquisitions else None,
+            "acquire_timeouts": self.acquire_timeouts
+        }
+
+# Client recording every command's round trip (including waiting for a connection) in the metrics, against the
+# request being handled
+class Instrumented_Redis(redis.asyncio.Redis):
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args,**options)
+        finally:
+            record_redis((str(args[0]).upper(),),time.perf_counter()-start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return Instrumented_Pipeline(self.connection_pool,self.response_callbacks,transaction,shard_hint)
+
+# Pipelines are one round trip, recorded as PIPELINE while still counting each queued command
+class Instrumented_Pipeline(redis.asyncio.client.Pipeline):
+    async def execute(self, raise_on_error=True):
+        commands = tuple(str(i[0][0]).upper() for i in self.command_stack)
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            if commands:
+                record_redis(commands,time.perf_counter()-start,"PIPELINE")
+
+def create_pool():
+    kwargs = {
+        "max_connections": REDIS_POOL_SIZE,
+        "timeout": REDIS_POOL_TIMEOUT,
+        "socket_timeout": REDIS_SOCKET_TIMEOUT,
+        "socket_connect_timeout": REDIS_CONNECT_TIMEOUT,
+        "health_check_interval": REDIS_HEALTH_CHECK_INTERVAL
+    }
+    if REDIS_UNIX_SOCKET:
+        kwargs["connection_class"] = redis.asyncio.UnixDomainSocketConnection
+        kwargs["path"] = REDIS_UNIX_SOCKET
+    else:
+        kwargs["host"] = REDIS_HOST
+        kwargs["port"] = REDIS_PORT
+    return Instrumented_Connection_Pool(**kwargs)
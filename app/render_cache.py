@@ -0,0 +1,165 @@
+from collections import OrderedDict
+import threading
+import os
+
+# Rendered image responses are cached per (identifier, generation, frame key, codec) - generation changes whenever
+# the original is updated, frame key identifies the blend weight of the fetch (see image_utils.frame_key),
+# and codec is the one negotiated from the request's Accept header.
+# An in-process LRU sits in front of an optional Redis tier shared between workers, which is enabled by
+# setting RENDER_CACHE_REDIS_TTL to a positive number of seconds.
+# Frames prerendered by ingestion are only made once, by whichever worker consumed the job, so they always go
+# to Redis (kept RENDER_CACHE_PRERENDER_TTL seconds) for every worker to find - with the Redis tier otherwise
+# off, this costs a Redis lookup on each local miss. Setting RENDER_CACHE_PRERENDER_TTL to 0 as well turns the
+# Redis tier off entirely, along with prerendering.
+RENDER_CACHE_BUDGET = int(os.environ.get("RENDER_CACHE_BUDGET",64*1024*1024))
+RENDER_CACHE_REDIS_TTL = int(os.environ.get("RENDER_CACHE_REDIS_TTL",0))
+RENDER_CACHE_PRERENDER_TTL = int(os.environ.get("RENDER_CACHE_PRERENDER_TTL",60*60))
+RENDER_KEY_PREFIX = "imgrender_"
+RENDER_INDEX_KEY_PREFIX = "imgrenders_"
+
+def render_etag(identifier, generation, frame, codec):
+    return '"{}-{}-{}-{}"'.format(identifier,generation,frame,codec)
+
+# Weak comparison of an If-None-Match header against an ETag, as required for conditional GETs
+def etag_matches(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    candidates = [i.strip() for i in if_none_match.split(",")]
+    return "*" in candidates or etag in [i[2:] if i.startswith("W/") else i for i in candidates]
+
+# Split an ETag made by render_etag back into (identifier, generation, frame, codec), or None if it is not one
+def parse_render_etag(etag):
+    parts = etag.strip().strip('"').split("-")
+    if not len(parts)==4 or not parts[1].isdigit() or not parts[2].isdigit():
+        return None
+    return parts[0], int(parts[1]), int(parts[2]), parts[3]
+
+class Range_Not_Satisfiable(Exception):
+    pass
+
+# Parse a Range header against a body of size bytes, returning the inclusive (start, end) to serve, or None if
+# the whole body should be served instead (unparseable headers and multiple ranges are ignored, as allowed).
+# Raises Range_Not_Satisfiable if the range lies entirely past the end.
+def parse_byte_range(range_header, size):
+    unit, _, spec = range_header.partition("=")
+    if not unit.strip().lower()=="bytes" or "," in spec:
+        return None
+    first, dash, last = [i.strip() for i in spec.partition("-")]
+    if not dash or not all(i.isdigit() for i in (first,last) if i) or not (first or last):
+        return None
+    if not first:
+        if int(last)==0:
+            raise Range_Not_Satisfiable()
+        return max(size-int(last),0), size-1
+    if last and int(last) < int(first):
+        return None
+    if int(first) >= size:
+        raise Range_Not_Satisfiable()
+    return int(first), min(int(last),size-1) if last else size-1
+
+class Render_Cache:
+    def __init__(self, byte_budget=RENDER_CACHE_BUDGET, redis_ttl=RENDER_CACHE_REDIS_TTL, prerender_ttl=RENDER_CACHE_PRERENDER_TTL):
+        self.byte_budget = byte_budget
+        self.redis_ttl = redis_ttl
+        self.prerender_ttl = prerender_ttl
+        self.entries = OrderedDict()
+        self.keys_by_identifier = {}
+        self.bytes_used = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.not_modified = 0
+
+    # Whether renders can be shared between workers through Redis
+    def shared(self):
+        return self.redis_ttl > 0 or self.prerender_ttl > 0
+
+    def _redis_key(self, key):
+        return "{}{}_{}_{}_{}".format(RENDER_KEY_PREFIX,*key)
+
+    def _put_local(self, key, content):
+        if len(content) > self.byte_budget:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = content
+            self.keys_by_identifier.setdefault(key[0],set()).add(key)
+            self.bytes_used += len(content)
+            while self.bytes_used > self.byte_budget:
+                evicted_key, evicted_content = self.entries.popitem(last=False)
+                self.bytes_used -= len(evicted_content)
+                self.keys_by_identifier[evicted_key[0]].discard(evicted_key)
+                if not self.keys_by_identifier[evicted_key[0]]:
+                    del self.keys_by_identifier[evicted_key[0]]
+                self.evictions += 1
+
+    # Get rendered content from the local LRU, then from the Redis tier if enabled, or None if not cached
+    async def get(self, redis_client, identifier, generation, frame, codec):
+        key = (identifier,generation,frame,codec)
+        with self.lock:
+            content = self.entries.get(key)
+            if content is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return content
+        if self.shared():
+            content = await redis_client.get(self._redis_key(key))
+            if content is not None:
+                self._put_local(key,content)
+                with self.lock:
+                    self.redis_hits += 1
+                return content
+        with self.lock:
+            self.misses += 1
+        return None
+
+    # Cache rendered content - prerendered content goes to Redis under the prerender TTL, other content only if
+    # the Redis tier is enabled
+    async def put(self, redis_client, identifier, generation, frame, codec, content, prerendered=False):
+        key = (identifier,generation,frame,codec)
+        self._put_local(key,content)
+        ttl = self.prerender_ttl if prerendered else self.redis_ttl
+        if ttl > 0:
+            index_key = "{}{}".format(RENDER_INDEX_KEY_PREFIX,identifier)
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.set(self._redis_key(key),content,ex=ttl)
+            pipe.sadd(index_key,self._redis_key(key))
+            # The index outlives every render it lists, whichever TTL they were set with
+            pipe.expire(index_key,max(self.redis_ttl,self.prerender_ttl))
+            await pipe.execute()
+
+    # Drop all cached renders of an image - called when its original is replaced or deleted. Other workers'
+    # local entries are keyed by the old generation, so they can no longer be looked up and age out of the LRU.
+    async def invalidate(self, redis_client, identifier):
+        with self.lock:
+            for key in self.keys_by_identifier.pop(identifier,()):
+                self.bytes_used -= len(self.entries.pop(key))
+        if self.shared():
+            index_key = "{}{}".format(RENDER_INDEX_KEY_PREFIX,identifier)
+            render_keys = await redis_client.smembers(index_key)
+            await redis_client.delete(index_key,*render_keys)
+
+    def record_not_modified(self):
+        with self.lock:
+            self.not_modified += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "redis_hits": self.redis_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "not_modified": self.not_modified,
+                "entries": len(self.entries),
+                "bytes_used": self.bytes_used,
+                "byte_budget": self.byte_budget,
+                "redis_ttl": self.redis_ttl,
+                "prerender_ttl": self.prerender_ttl
+            }
+
+# Process-wide rendered output cache
+render_cache = Render_Cache()
@@ -0,0 +1,136 @@
+from email.utils import formatdate, parsedate_to_datetime
+import asyncio
+import gzip
+import hashlib
+import mimetypes
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from render_cache import etag_matches
+
+# Text assets under perm_contents are loaded into memory at startup, with gzip and brotli (if installed) variants,
+# strong ETags and Last-Modified precomputed, so serving them never touches the disk. Setting STATIC_WATCH
+# polls the files every STATIC_WATCH_INTERVAL seconds and reloads any that changed, for development.
+STATIC_DIR = "./perm_contents"
+STATIC_WATCH = os.environ.get("STATIC_WATCH","0")=="1"
+STATIC_WATCH_INTERVAL = float(os.environ.get("STATIC_WATCH_INTERVAL",1))
+COMPRESSIBLE_TYPES = ("text/","application/json","application/javascript","image/svg+xml")
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+# Encodings in order of preference when the client accepts several equally
+ENCODERS = {"br": None if brotli is None else lambda data: brotli.compress(data,quality=BROTLI_QUALITY), "gzip": lambda data: gzip.compress(data,GZIP_LEVEL,mtime=0)}
+
+def is_compressible(media_type):
+    return any(media_type.startswith(i) for i in COMPRESSIBLE_TYPES)
+
+class Static_Asset:
+    def __init__(self, path):
+        with open(path,"rb") as f:
+            content = f.read()
+        stat = os.stat(path)
+        self.signature = (stat.st_mtime_ns,stat.st_size)
+        self.media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.last_modified = formatdate(int(stat.st_mtime),usegmt=True)
+        self.modified_time = int(stat.st_mtime)
+
+        # Each encoding is a different representation, so each gets its own strong ETag. Variants that do not
+        # come out smaller than the original are not kept.
+        digest = hashlib.sha256(content).hexdigest()[:32]
+        self.variants = {"identity": (content,'"{}"'.format(digest))}
+        for encoding, encoder in ENCODERS.items():
+            if encoder is None:
+                continue
+            encoded = encoder(content)
+            if len(encoded) < len(content):
+                self.variants[encoding] = (encoded,'"{}-{}"'.format(digest,encoding))
+
+    # Pick a variant from an Accept-Encoding header, honouring q-values - identity unless something better is accepted
+    def negotiate(self, accept_encoding):
+        if accept_encoding is None:
+            return "identity"
+        accepted = {}
+        for entry in accept_encoding.split(","):
+            params = [i.strip() for i in entry.split(";")]
+            q = 1.0
+            for param in params[1:]:
+                if param.startswith("q="):
+                    try:
+                        q = float(param[2:])
+                    except ValueError:
+                        q = 0.0
+            accepted[params[0].lower()] = q
+        best_encoding, best_q = "identity", 0.0
+        for encoding in ENCODERS:
+            q = accepted.get(encoding,accepted.get("*",0.0))
+            if encoding in self.variants and q > best_q:
+                best_encoding, best_q = encoding, q
+        return best_encoding
+
+    # Whether a conditional request can be answered with 304 - If-None-Match takes precedence over If-Modified-Since
+    def not_modified(self, etag, if_none_match, if_modified_since):
+        if not if_none_match==None:
+            return etag_matches(if_none_match,etag)
+        if not if_modified_since==None:
+            try:
+                return self.modified_time <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    # Returns (status, body, headers) for a GET of this asset
+    def serve(self, accept_encoding=None, if_none_match=None, if_modified_since=None):
+        encoding = self.negotiate(accept_encoding)
+        content, etag = self.variants[encoding]
+        headers = {"ETag": etag, "Last-Modified": self.last_modified, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+        if self.not_modified(etag,if_none_match,if_modified_since):
+            return 304, b"", headers
+        if not encoding=="identity":
+            headers["Content-Encoding"] = encoding
+        return 200, content, headers
+
+class Static_Assets:
+    def __init__(self, directory=STATIC_DIR):
+        self.directory = directory
+        self.assets = {}
+        self.reloads = 0
+
+    def _paths(self):
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory,name)
+            if os.path.isfile(path) and is_compressible(mimetypes.guess_type(path)[0] or ""):
+                yield name, path
+
+    def load(self):
+        self.assets = {name: Static_Asset(path) for name, path in self._paths()}
+
+    def get(self, name):
+        return self.assets[name]
+
+    # Reload assets whose modification time or size changed, pick up new ones and drop deleted ones
+    def refresh(self):
+        assets = {}
+        for name, path in self._paths():
+            stat = os.stat(path)
+            asset = self.assets.get(name)
+            if asset is None or not asset.signature==(stat.st_mtime_ns,stat.st_size):
+                asset = Static_Asset(path)
+                self.reloads += 1
+            assets[name] = asset
+        self.assets = assets
+
+    # Poll for changed files until cancelled
+    async def watch(self, interval=STATIC_WATCH_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.refresh()
+            except OSError:
+                pass
+
+# Process-wide static assets
+static_assets = Static_Assets()
@@ -0,0 +1,70 @@
+# Micro-benchmark for the fixed-point blend engine in image_utils against the previous float64 path
+# Run from anywhere with: python benchmarks/blend_benchmark.py [width] [height]
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","app")
+sys.path.insert(0,APP_DIR)
+os.chdir(APP_DIR)
+
+from image_utils import RICKROLL_RATE, blend_overlay
+
+REPEATS = 5
+
+# Previous blend - float64 conversion of both inputs and alpha channel built with np.concatenate
+def legacy_blend(img_data, overlay_data):
+    img_data = img_data.astype(np.float64)
+    overlay_data = overlay_data.astype(np.float64)
+    if overlay_data.shape[2]<img_data.shape[2]:
+        overlay_data = np.concatenate([overlay_data,255*np.ones((overlay_data.shape[0],overlay_data.shape[1],1))],axis=2)
+    new_img_data = (1-RICKROLL_RATE)*img_data + RICKROLL_RATE*overlay_data
+    return new_img_data.astype(np.uint8)
+
+# Best wall time and peak traced allocation over REPEATS runs
+def measure(blend, img_data, overlay_data):
+    best_time = None
+    peak = 0
+    for _ in range(REPEATS):
+        img_copy = img_data.copy()
+        tracemalloc.start()
+        start = time.perf_counter()
+        blend(img_copy,overlay_data)
+        elapsed = time.perf_counter()-start
+        peak = max(peak,tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        best_time = elapsed if best_time is None else min(best_time,elapsed)
+    return best_time, peak
+
+# Largest difference from the float64 result over every (pixel, overlay) pair of 8-bit values
+def max_lsb_error():
+    img_data, overlay_data = np.meshgrid(np.arange(256,dtype=np.uint8),np.arange(256,dtype=np.uint8))
+    img_data = img_data.reshape((256,256,1))
+    overlay_data = overlay_data.reshape((256,256,1))
+    expected = legacy_blend(img_data,overlay_data).astype(np.int32)
+    actual = blend_overlay(img_data.copy(),overlay_data).astype(np.int32)
+    return int(np.abs(expected-actual).max()), int((expected!=actual).sum())
+
+def main():
+    width = int(sys.argv[1]) if len(sys.argv)>1 else 3840
+    height = int(sys.argv[2]) if len(sys.argv)>2 else 2160
+    rng = np.random.default_rng(0)
+    overlay_data = rng.integers(0,256,(height,width,3),dtype=np.uint8)
+
+    error, mismatches = max_lsb_error()
+    print("max error vs float64: {} LSB ({} of 65536 input pairs differ)".format(error,mismatches))
+    print("{:<6}{:>14}{:>14}{:>16}{:>16}".format("mode","float64 ms","fixed ms","float64 MiB","fixed MiB"))
+    for mode, channels in [("RGB",3),("RGBA",4)]:
+        img_data = rng.integers(0,256,(height,width,channels),dtype=np.uint8)
+        legacy_time, legacy_peak = measure(legacy_blend,img_data,overlay_data)
+
+        # Overlay cache hands out overlays that already have the matching channel count
+        matched_overlay_data = np.full((height,width,channels),255,dtype=np.uint8)
+        matched_overlay_data[:,:,:3] = overlay_data
+        fixed_time, fixed_peak = measure(blend_overlay,img_data,matched_overlay_data)
+        print("{:<6}{:>14.1f}{:>14.1f}{:>16.1f}{:>16.1f}".format(mode,legacy_time*1000,fixed_time*1000,legacy_peak/2**20,fixed_peak/2**20))
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,51 @@
+# Benchmark for bulk contributor endpoints - onboarding and looking up contributors one request at a time
+# against POST/GET /contributors:batch, over a single keep-alive connection to a running server
+# Run from anywhere with: python benchmarks/contributor_batch_benchmark.py [host:port] [contributors]
+import http.client
+import json
+import sys
+import time
+
+SERVER = "127.0.0.1:8000"
+CONTRIBUTORS = 2000
+BATCH_SIZE = 1000
+
+def request(connection, method, path, body=None):
+    headers = {} if body is None else {"Content-Type": "application/json"}
+    connection.request(method,path,body=None if body is None else json.dumps(body),headers=headers)
+    response = connection.getresponse()
+    data = response.read()
+    assert response.status==200, data
+    return json.loads(data)
+
+def batches(items):
+    return [items[i:i+BATCH_SIZE] for i in range(0,len(items),BATCH_SIZE)]
+
+def delete_all(connection, contributors):
+    for i in contributors:
+        request(connection,"DELETE","/contributors/{}".format(i["username"]))
+
+def measure(name, count, function):
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter()-start
+    print("{:<22}{:>12.3f}{:>16.0f}".format(name,elapsed,count/elapsed))
+
+def main():
+    server = sys.argv[1] if len(sys.argv) > 1 else SERVER
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else CONTRIBUTORS
+    contributors = [{"username": "bench_{}".format(i), "name": "Bench User {}".format(i), "bio": "bio;{}".format(i)} for i in range(count)]
+    usernames = [i["username"] for i in contributors]
+    connection = http.client.HTTPConnection(server)
+
+    print("{} contributors, batches of {}".format(count,BATCH_SIZE))
+    print("{:<22}{:>12}{:>16}".format("path","seconds","contributors/s"))
+    measure("POST one at a time",count,lambda: [request(connection,"POST","/contributors",i) for i in contributors])
+    measure("GET one at a time",count,lambda: [request(connection,"GET","/contributors/{}".format(i)) for i in usernames])
+    delete_all(connection,contributors)
+    measure("POST batch",count,lambda: [request(connection,"POST","/contributors:batch",i) for i in batches(contributors)])
+    measure("GET batch",count,lambda: [request(connection,"GET","/contributors:batch?usernames={}".format(",".join(i))) for i in batches(usernames)])
+    delete_all(connection,contributors)
+
+if __name__=="__main__":
+    main()
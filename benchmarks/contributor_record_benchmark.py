@@ -0,0 +1,52 @@
+# Benchmark for contributor record encoding - the length-prefixed record format against the legacy "name;bio"
+# string (parsed the way the listing used to, with split and join), over 1M generated contributors
+# Run from anywhere with: python benchmarks/contributor_record_benchmark.py [contributors]
+import os
+import random
+import sys
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","app")
+sys.path.insert(0,APP_DIR)
+os.chdir(APP_DIR)
+
+from contributor_records import encode_record, decode_record
+
+CONTRIBUTORS = 1000000
+NAME_CHARS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 "
+BIO_CHARS = NAME_CHARS+";,.!"
+
+def legacy_encode(fields):
+    return "{};{}".format(fields["name"],fields["bio"]).encode()
+
+def legacy_decode(value):
+    value = value.decode().split(";")
+    return {"name": value[0], "bio": ";".join(value[1:])}
+
+def generate(count):
+    rng = random.Random(0)
+    return [{
+        "name": "".join(rng.choices(NAME_CHARS,k=rng.randint(3,30))),
+        "bio": "".join(rng.choices(BIO_CHARS,k=rng.randint(0,200)))
+    } for _ in range(count)]
+
+def measure(function, items):
+    start = time.perf_counter()
+    results = [function(i) for i in items]
+    return time.perf_counter()-start, results
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else CONTRIBUTORS
+    contributors = generate(count)
+    formats = [("legacy name;bio",legacy_encode,legacy_decode),("record v1",encode_record,decode_record)]
+
+    print("{} contributors".format(count))
+    print("{:<18}{:>18}{:>18}{:>16}".format("format","encode ns/rec","decode ns/rec","MiB stored"))
+    for name, encode, decode in formats:
+        encode_time, values = measure(encode,contributors)
+        decode_time, decoded = measure(decode,values)
+        assert decoded==contributors
+        print("{:<18}{:>18.0f}{:>18.0f}{:>16.1f}".format(name,encode_time/count*1e9,decode_time/count*1e9,sum(len(i) for i in values)/1024/1024))
+
+if __name__=="__main__":
+    main()
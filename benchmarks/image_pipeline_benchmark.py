@@ -0,0 +1,168 @@
+# Stage-by-stage benchmark of the image pipeline on synthetic PNGs across sizes, modes and compression levels -
+# upload validation (check_png, plain and strict) and each step of apply_shitpost: decode, overlay resize (cold,
+# then from the overlay cache), blend and encode, plus apply_shitpost end to end. Times are the best of
+# --repeats runs. Peak traced memory of apply_shitpost is measured in a separate untimed run - tracemalloc
+# sees Python and numpy allocations, but not Pillow's internal image buffers.
+# Results can be written as JSON with --json, and compared against a stored run with --baseline, which exits
+# with status 1 if any timing regressed by more than --threshold.
+# Run from anywhere with: python benchmarks/image_pipeline_benchmark.py [--sizes 64px,4K] [--modes RGB,P] [--levels 1,9]
+# The full matrix up to 8K takes several minutes and a few GB of memory - narrow it down for quick checks.
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+import numpy as np
+import PIL
+from PIL import Image
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","app")
+sys.path.insert(0,APP_DIR)
+os.chdir(APP_DIR)
+
+from image_utils import check_png, decode_for_blend, blend_overlay, apply_shitpost, frame_key, FRAME_KEY_BITS
+from image_codecs import encode_image, codec_for_mode
+from overlay_cache import Overlay_Cache, overlay_cache
+
+SIZES = {"64px": (64,64), "512px": (512,512), "1080p": (1920,1080), "4K": (3840,2160), "8K": (7680,4320)}
+MODES = ("L","LA","RGB","RGBA","P","I;16")
+COMPRESS_LEVELS = (1,6,9)
+REPEATS = 3
+THRESHOLD = 1.25
+FETCH_COUNT = 1
+TIMINGS = ("check_png_ms","check_png_strict_ms","decode_ms","overlay_resize_ms","overlay_cached_ms","blend_ms","encode_ms","apply_shitpost_ms")
+LABELS = ("check","strict","decode","resize","overlay hit","blend","encode","total")
+# Differences below this are timer noise on the smallest images, and never count as regressions
+MIN_REGRESSION_MS = 0.5
+
+# Gradient plus noise, so that compression levels make a realistic difference
+def synthetic_png(width, height, mode, compress_level):
+    rng = np.random.default_rng(0)
+    gradient = np.add.outer(np.linspace(0,1,height),np.linspace(0,1,width))/2
+    channels = {"L": 1, "LA": 2, "RGB": 3, "RGBA": 4, "P": 1, "I;16": 1}[mode]
+    noise = rng.normal(0,0.05,(height,width,channels)) if channels > 1 else rng.normal(0,0.05,(height,width))
+    values = np.clip((gradient if channels==1 else gradient[:,:,None])+noise,0,1)
+    if mode=="I;16":
+        img = Image.fromarray((values*65535).astype(np.uint16))
+    elif mode=="P":
+        img = Image.frombytes("P",(width,height),(values*255).astype(np.uint8).tobytes())
+        img.putpalette(rng.integers(0,256,768,dtype=np.uint8).tobytes())
+    else:
+        img = Image.fromarray((values*255).astype(np.uint8))
+    buffer = io.BytesIO()
+    img.save(buffer,format="PNG",compress_level=compress_level)
+    img.close()
+    return buffer.getvalue()
+
+# Best wall time in milliseconds over repeats runs, with the result of the last one
+def best_time(function, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter()-start
+        best = elapsed if best is None else min(best,elapsed)
+    return best*1000, result
+
+def decode(file):
+    with Image.open(io.BytesIO(file)) as img:
+        return decode_for_blend(img)
+
+# Time each stage the way render_image and apply_shitpost chain them
+def measure_case(file, codec, repeats):
+    row = {}
+    row["check_png_ms"], _ = best_time(lambda: check_png(file),repeats)
+    row["check_png_strict_ms"], _ = best_time(lambda: check_png(file,strict=True),repeats)
+    row["decode_ms"], img_data = best_time(lambda: decode(file),repeats)
+
+    height, width = img_data.shape[:2]
+    channels = 1 if img_data.ndim==2 else img_data.shape[2]
+    row["overlay_resize_ms"], overlay_data = best_time(lambda: overlay_cache._render(width,height,channels),repeats)
+    overlay_cache.get(width,height,channels)
+    row["overlay_cached_ms"], _ = best_time(lambda: overlay_cache.get(width,height,channels),repeats)
+
+    rate = frame_key(FETCH_COUNT)/(1 << FRAME_KEY_BITS)
+    row["blend_ms"], _ = best_time(lambda: blend_overlay(img_data.copy(),overlay_data,rate),repeats)
+    blended = blend_overlay(img_data,overlay_data,rate)
+    output_codec = codec_for_mode(codec,Image.fromarray(blended).mode)
+    row["encode_ms"], encoded = best_time(lambda: encode_image(Image.fromarray(blended),output_codec),repeats)
+    row["output_bytes"] = len(encoded)
+    row["apply_shitpost_ms"], _ = best_time(lambda: apply_shitpost(file,FETCH_COUNT,codec),repeats)
+
+    tracemalloc.start()
+    apply_shitpost(file,FETCH_COUNT,codec)
+    row["apply_shitpost_peak_traced_bytes"] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return row
+
+# Timings of this run against a baseline run, as (case, timing, baseline ms, current ms) for those slower by
+# more than threshold (and by more than MIN_REGRESSION_MS)
+def compare(results, baseline, threshold):
+    baseline_rows = {i["case"]: i for i in baseline["results"]}
+    regressions = []
+    for row in results:
+        baseline_row = baseline_rows.get(row["case"])
+        if baseline_row is None:
+            continue
+        for timing in TIMINGS:
+            if timing in baseline_row and row[timing] > max(baseline_row[timing]*threshold,baseline_row[timing]+MIN_REGRESSION_MS):
+                regressions.append((row["case"],timing,baseline_row[timing],row[timing]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes",default=",".join(SIZES))
+    parser.add_argument("--modes",default=",".join(MODES))
+    parser.add_argument("--levels",default=",".join(str(i) for i in COMPRESS_LEVELS))
+    parser.add_argument("--codec",default="png")
+    parser.add_argument("--repeats",type=int,default=REPEATS)
+    parser.add_argument("--json",help="write the results to this file")
+    parser.add_argument("--baseline",help="compare against results written by an earlier run")
+    parser.add_argument("--threshold",type=float,default=THRESHOLD)
+    args = parser.parse_args()
+
+    # The overlay source decode is a one-off per process, so it is timed once on a fresh cache
+    start = time.perf_counter()
+    Overlay_Cache().load()
+    overlay_load_ms = (time.perf_counter()-start)*1000
+    overlay_cache.load()
+    print("overlay load {:.1f} ms".format(overlay_load_ms))
+
+    header = "{:<20}{:>10}".format("case","KiB")+"".join("{:>12}".format(i) for i in LABELS)+"{:>12}".format("peak MiB")
+    print(header)
+    results = []
+    for size in args.sizes.split(","):
+        width, height = SIZES[size]
+        for mode in args.modes.split(","):
+            for level in [int(i) for i in args.levels.split(",")]:
+                file = synthetic_png(width,height,mode,level)
+                row = {"case": "{} {} z{}".format(size,mode,level), "width": width, "height": height, "mode": mode, "compress_level": level, "file_bytes": len(file)}
+                row.update(measure_case(file,args.codec,args.repeats))
+                results.append(row)
+                print("{:<20}{:>10.0f}".format(row["case"],len(file)/1024)+"".join("{:>12.2f}".format(row[i]) for i in TIMINGS)+"{:>12.1f}".format(row["apply_shitpost_peak_traced_bytes"]/2**20))
+
+    output = {
+        "meta": {"python": platform.python_version(), "numpy": np.__version__, "pillow": PIL.__version__, "machine": platform.machine(), "codec": args.codec, "repeats": args.repeats},
+        "overlay_load_ms": overlay_load_ms,
+        # ru_maxrss is in KiB on Linux
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024,
+        "results": results
+    }
+    if args.json:
+        with open(args.json,"w") as f:
+            json.dump(output,f,indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results,json.load(f),args.threshold)
+        for case, timing, baseline_ms, current_ms in regressions:
+            print("REGRESSION {:<20}{:<22}{:>10.2f} ms -> {:.2f} ms".format(case,timing,baseline_ms,current_ms))
+        if regressions:
+            sys.exit(1)
+
+if __name__=="__main__":
+    main()
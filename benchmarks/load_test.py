@@ -0,0 +1,180 @@
+# Load test replaying the checkoff .http fixtures - fixtures are parsed once into request templates, then
+# concurrent tasks pick one at random (weighted by the mix) and send it over a shared pooled client until the
+# duration is up. Throughput, p50/p95/p99 latency and status codes are reported per fixture.
+# Against a running server: python benchmarks/load_test.py --target http://127.0.0.1:8000
+# In-process, against the app on an in-memory fakeredis server (no Docker needed):
+# python benchmarks/load_test.py --in-process
+# Mixes are fixture names with weights, e.g. --mix contributors_get_basic=4,root_get_basic=1. Setup fixtures are
+# sent once before the run, so that fixtures reading existing contributors find them.
+# Needs httpx, and fakeredis for --in-process. In-process numbers include the client's own overhead on the same
+# event loop, so they are for comparing revisions rather than capacity planning.
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+import httpx
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+APP_DIR = os.path.join(ROOT_DIR,"app")
+CHECKOFF_DIR = os.path.join(ROOT_DIR,"checkoff")
+HTTP_FILES_DIR = os.path.join(CHECKOFF_DIR,"http_files")
+sys.path.insert(0,CHECKOFF_DIR)
+
+from test_helpers import parse_http_bytes
+
+TARGET = "http://127.0.0.1:8000"
+CONCURRENCY = 16
+DURATION = 10
+WARMUP = 1
+DEFAULT_MIX = {
+    "root_get_basic": 1,
+    "contributors_get_basic": 2,
+    "contributors_get_combined_1": 2,
+    "contributors_username_get_1": 4,
+    "contributors_batch_get_1": 2,
+    "contributors_post_1": 1,
+    "stats_overlay_get_basic": 1
+}
+DEFAULT_SETUP = ["contributors_post_1","contributors_post_2","contributors_post_3","contributors_post_4","contributors_post_5"]
+# Headers the client computes itself for the target it is pointed at
+SKIPPED_HEADERS = ("host","content-length")
+
+# Load a fixture as (method, path with query, headers, body). The fixtures' line endings depend on the checkout,
+# so the head is normalised to CRLF before being handed to the checkoff parser.
+def load_fixture(name):
+    with open(os.path.join(HTTP_FILES_DIR,"{}.http".format(name)),"rb") as f:
+        raw = f.read()
+    if b"\r\n\r\n" not in raw:
+        head, _, body = raw.partition(b"\n\n")
+        raw = head.replace(b"\n",b"\r\n")+b"\r\n\r\n"+body
+    top, headers, body = parse_http_bytes(raw)
+    url = urllib.parse.urlsplit(top[1])
+    path = url.path+("?"+url.query if url.query else "")
+    headers = {i: j for i, j in headers.items() if i and i.lower() not in SKIPPED_HEADERS}
+    return top[0], path, headers, body
+
+def parse_mix(mix):
+    weights = {}
+    for entry in mix.split(","):
+        name, _, weight = entry.partition("=")
+        weights[name.strip()] = float(weight) if weight else 1.0
+    return weights
+
+# Nearest-rank percentile of sorted samples
+def percentile(samples, fraction):
+    return samples[min(len(samples)-1,max(0,int(round(fraction*len(samples)))-1))]
+
+async def send(client, fixture):
+    method, path, headers, body = fixture
+    response = await client.request(method,path,headers=headers,content=body or None)
+    await response.aread()
+    return response.status_code
+
+# One task's loop - only requests completed after the warmup are recorded
+async def worker(client, fixtures, names, weights, warmup_end, end, results):
+    while True:
+        name = random.choices(names,weights)[0]
+        start = time.perf_counter()
+        try:
+            status = await send(client,fixtures[name])
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        finished = time.perf_counter()
+        if finished >= end:
+            return
+        if finished >= warmup_end:
+            result = results[name]
+            result["latencies"].append(finished-start)
+            result["statuses"][str(status)] = result["statuses"].get(str(status),0)+1
+
+async def run(client, fixtures, weights, setup, concurrency, duration, warmup):
+    for name in setup:
+        await send(client,fixtures[name])
+    names = list(weights)
+    results = {i: {"latencies": [], "statuses": {}} for i in names}
+    warmup_end = time.perf_counter()+warmup
+    end = warmup_end+duration
+    await asyncio.gather(*[worker(client,fixtures,names,[weights[i] for i in names],warmup_end,end,results) for _ in range(concurrency)])
+    return results
+
+def summarise_latencies(latencies, statuses, duration):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "requests_per_second": len(latencies)/duration,
+        "p50_ms": percentile(latencies,0.5)*1000 if latencies else None,
+        "p95_ms": percentile(latencies,0.95)*1000 if latencies else None,
+        "p99_ms": percentile(latencies,0.99)*1000 if latencies else None,
+        "statuses": statuses
+    }
+
+def summarise(results, duration):
+    summary = {i: summarise_latencies(j["latencies"],j["statuses"],duration) for i, j in results.items()}
+    statuses = {}
+    for result in results.values():
+        for status, count in result["statuses"].items():
+            statuses[status] = statuses.get(status,0)+count
+    summary["total"] = summarise_latencies([i for j in results.values() for i in j["latencies"]],statuses,duration)
+    return summary
+
+def print_summary(summary):
+    print("{:<32}{:>10}{:>10}{:>10}{:>10}{:>10}  {}".format("fixture","requests","req/s","p50 ms","p95 ms","p99 ms","statuses"))
+    for name, row in summary.items():
+        latencies = ["{:.2f}".format(row[i]) if not row[i] is None else "-" for i in ("p50_ms","p95_ms","p99_ms")]
+        statuses = " ".join("{}x{}".format(i,j) for i, j in sorted(row["statuses"].items()))
+        print("{:<32}{:>10}{:>10.0f}{:>10}{:>10}{:>10}  {}".format(name,row["requests"],row["requests_per_second"],*latencies,statuses))
+
+# Serve an in-memory Redis over TCP on a free port in a background thread, returning the port
+def start_fake_redis():
+    from fakeredis import TcpFakeServer
+    server = TcpFakeServer(("127.0.0.1",0),server_type="redis")
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    return server.server_address[1]
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target",default=TARGET)
+    parser.add_argument("--in-process",action="store_true")
+    parser.add_argument("--concurrency",type=int,default=CONCURRENCY)
+    parser.add_argument("--duration",type=float,default=DURATION)
+    parser.add_argument("--warmup",type=float,default=WARMUP)
+    parser.add_argument("--mix",default=",".join("{}={}".format(i,j) for i, j in DEFAULT_MIX.items()))
+    parser.add_argument("--setup",default=",".join(DEFAULT_SETUP))
+    parser.add_argument("--json",help="write the summary to this file")
+    args = parser.parse_args()
+
+    weights = parse_mix(args.mix)
+    setup = [i for i in args.setup.split(",") if i]
+    fixtures = {i: load_fixture(i) for i in set(weights)|set(setup)}
+    limits = httpx.Limits(max_connections=args.concurrency,max_keepalive_connections=args.concurrency)
+
+    if args.in_process:
+        # The app reads its configuration at import, and serves static files relative to its own directory. No
+        # fixture makes async uploads, so the ingest stream consumer is left off unless asked for.
+        os.environ["REDIS_HOST"] = "127.0.0.1"
+        os.environ["REDIS_PORT"] = str(start_fake_redis())
+        os.environ.setdefault("INGEST_CONSUMER","0")
+        sys.path.insert(0,APP_DIR)
+        os.chdir(APP_DIR)
+        from main import app
+        async with app.router.lifespan_context(app):
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app),base_url="http://testserver",limits=limits) as client:
+                results = await run(client,fixtures,weights,setup,args.concurrency,args.duration,args.warmup)
+    else:
+        async with httpx.AsyncClient(base_url=args.target,limits=limits,timeout=30) as client:
+            results = await run(client,fixtures,weights,setup,args.concurrency,args.duration,args.warmup)
+
+    summary = summarise(results,args.duration)
+    print("{} tasks, {}s (+{}s warmup), {}".format(args.concurrency,args.duration,args.warmup,"in-process" if args.in_process else args.target))
+    print_summary(summary)
+    if args.json:
+        with open(args.json,"w") as f:
+            json.dump(summary,f,indent=2)
+
+if __name__=="__main__":
+    asyncio.run(main())
@@ -0,0 +1,59 @@
+# Overhead of the /metrics instrumentation - runs the in-process load test (see load_test.py) with METRICS_ENABLED
+# off and on, alternating between them for --rounds rounds so that drift in the machine's load affects both
+# alike, and compares the best throughput and median p50/p99 latency of each. Each run is a fresh process, as the
+# setting is read at import.
+# Run from anywhere with: python benchmarks/metrics_overhead_benchmark.py [--rounds 3] [--duration 5]
+# Extra arguments after -- are passed on to the load test, e.g. -- --mix contributors_username_get_1=1
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+LOAD_TEST = os.path.join(os.path.dirname(os.path.abspath(__file__)),"load_test.py")
+ROUNDS = 3
+DURATION = 5
+MODES = {"off": "0", "on": "1"}
+
+# One in-process load test run with metrics set as given, returning its total summary
+def run_load_test(metrics_enabled, duration, extra_args):
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory,"summary.json")
+        env = dict(os.environ,METRICS_ENABLED=metrics_enabled)
+        subprocess.run([sys.executable,LOAD_TEST,"--in-process","--duration",str(duration),"--json",output]+extra_args,env=env,check=True,stdout=subprocess.DEVNULL)
+        with open(output) as f:
+            return json.load(f)["total"]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds",type=int,default=ROUNDS)
+    parser.add_argument("--duration",type=float,default=DURATION)
+    parser.add_argument("--json",help="write the results to this file")
+    parser.add_argument("load_test_args",nargs="*")
+    args = parser.parse_args()
+
+    runs = {i: [] for i in MODES}
+    for round_number in range(args.rounds):
+        for mode, value in MODES.items():
+            total = run_load_test(value,args.duration,args.load_test_args)
+            runs[mode].append(total)
+            print("round {} metrics {:<4}{:>10.0f} req/s{:>10.2f} ms p50{:>10.2f} ms p99".format(round_number+1,mode,total["requests_per_second"],total["p50_ms"],total["p99_ms"]))
+
+    results = {}
+    for mode, totals in runs.items():
+        results[mode] = {
+            "best_requests_per_second": max(i["requests_per_second"] for i in totals),
+            "median_p50_ms": statistics.median(i["p50_ms"] for i in totals),
+            "median_p99_ms": statistics.median(i["p99_ms"] for i in totals)
+        }
+    throughput_change = results["on"]["best_requests_per_second"]/results["off"]["best_requests_per_second"]-1
+    p50_change = results["on"]["median_p50_ms"]-results["off"]["median_p50_ms"]
+    print("metrics on vs off: {:+.1%} req/s, {:+.3f} ms p50, {:+.3f} ms p99".format(throughput_change,p50_change,results["on"]["median_p99_ms"]-results["off"]["median_p99_ms"]))
+    if args.json:
+        with open(args.json,"w") as f:
+            json.dump({"runs": runs, "results": results},f,indent=2)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,92 @@
+# Decode time saved by storing originals as raw pixels (IMAGE_STORAGE_FORMAT=pixels) against the extra storage it
+# takes, on the synthetic PNGs of image_pipeline_benchmark. For each case, reading an original is timed as a fetch
+# does it - reassembling the blob from its BLOB_CHUNK_SIZE chunks, then decoding the PNG or viewing the pixels -
+# along with render_image from each format, and the one-off conversion paid when a new blob is stored.
+# Times are the best of --repeats runs. Results can be written as JSON with --json.
+# Run from anywhere with: python benchmarks/pixel_storage_benchmark.py [--sizes 64px,4K] [--modes RGB,P] [--levels 1,9]
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import numpy as np
+import PIL
+from PIL import Image
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","app")
+sys.path.insert(0,APP_DIR)
+os.chdir(APP_DIR)
+
+from image_pipeline_benchmark import synthetic_png, best_time, SIZES, MODES, COMPRESS_LEVELS, REPEATS, FETCH_COUNT
+
+from image_utils import decode_for_blend, render_image, png_to_pixels
+from image_store import BLOB_CHUNK_SIZE
+from pixel_format import decode_pixels
+from overlay_cache import overlay_cache
+
+# A blob as Redis replies with it, one bytes object per chunk
+def split_chunks(file):
+    return [file[i:i+BLOB_CHUNK_SIZE] for i in range(0,len(file),BLOB_CHUNK_SIZE)]
+
+def read_png(chunks):
+    with Image.open(io.BytesIO(b"".join(chunks))) as img:
+        return decode_for_blend(img)
+
+def read_pixels(chunks):
+    return decode_pixels(bytearray().join(chunks))
+
+def measure_case(file, repeats):
+    row = {}
+    row["convert_ms"], pixels = best_time(lambda: png_to_pixels(file),repeats)
+    row["png_bytes"] = len(file)
+    row["pixel_bytes"] = len(pixels)
+    png_chunks = split_chunks(file)
+    pixel_chunks = split_chunks(pixels)
+    row["png_read_ms"], png_data = best_time(lambda: read_png(png_chunks),repeats)
+    row["pixel_read_ms"], pixel_data = best_time(lambda: read_pixels(pixel_chunks),repeats)
+    assert np.array_equal(png_data,pixel_data)
+    row["png_render_ms"], _ = best_time(lambda: render_image(file,FETCH_COUNT),repeats)
+    row["pixel_render_ms"], _ = best_time(lambda: render_image(bytearray(pixels),FETCH_COUNT),repeats)
+    row["saved_ms"] = row["png_read_ms"]-row["pixel_read_ms"]
+    row["extra_bytes"] = row["pixel_bytes"]-row["png_bytes"]
+    return row
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes",default=",".join(SIZES))
+    parser.add_argument("--modes",default=",".join(MODES))
+    parser.add_argument("--levels",default=",".join(str(i) for i in COMPRESS_LEVELS))
+    parser.add_argument("--repeats",type=int,default=REPEATS)
+    parser.add_argument("--json",help="write the results to this file")
+    args = parser.parse_args()
+
+    overlay_cache.load()
+    columns = ("PNG KiB","pixel KiB","PNG read","pixel read","PNG render","px render","convert","saved ms")
+    print("{:<20}".format("case")+"".join("{:>12}".format(i) for i in columns))
+    results = []
+    for size in args.sizes.split(","):
+        width, height = SIZES[size]
+        for mode in args.modes.split(","):
+            for level in [int(i) for i in args.levels.split(",")]:
+                file = synthetic_png(width,height,mode,level)
+                row = {"case": "{} {} z{}".format(size,mode,level), "width": width, "height": height, "mode": mode, "compress_level": level}
+                row.update(measure_case(file,args.repeats))
+                results.append(row)
+                values = (row["png_bytes"]/1024,row["pixel_bytes"]/1024,row["png_read_ms"],row["pixel_read_ms"],row["png_render_ms"],row["pixel_render_ms"],row["convert_ms"],row["saved_ms"])
+                print("{:<20}".format(row["case"])+"".join("{:>12.2f}".format(i) for i in values))
+
+    # Decode time saved per fetch for each extra MiB stored, over the whole matrix
+    saved_ms = sum(i["saved_ms"] for i in results)
+    extra_mib = sum(i["extra_bytes"] for i in results)/2**20
+    print("total: {:.1f} ms saved per fetch of each case, for {:.1f} MiB extra storage ({:.2f} ms/MiB)".format(saved_ms,extra_mib,saved_ms/extra_mib if extra_mib > 0 else float("inf")))
+    if args.json:
+        output = {
+            "meta": {"python": platform.python_version(), "numpy": np.__version__, "pillow": PIL.__version__, "machine": platform.machine(), "blob_chunk_size": BLOB_CHUNK_SIZE, "repeats": args.repeats},
+            "results": results
+        }
+        with open(args.json,"w") as f:
+            json.dump(output,f,indent=2)
+
+if __name__=="__main__":
+    main()
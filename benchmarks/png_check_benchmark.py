@@ -0,0 +1,80 @@
+# Benchmark for PNG upload validation - header-only chunk validation against opening with PIL
+# (the previous check) and strict mode (full decode), on small, 4K and hostile inputs
+# Run from anywhere with: python benchmarks/png_check_benchmark.py
+import io
+import os
+import struct
+import sys
+import time
+import zlib
+import numpy as np
+from PIL import Image
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","app")
+sys.path.insert(0,APP_DIR)
+os.chdir(APP_DIR)
+
+from image_utils import check_png
+
+REPEATS = 20
+
+# Previous check - signature comparison and Image.open
+def legacy_check_png(file):
+    if not file[:8]==bytes.fromhex("89504E470D0A1A0A"):
+        return False, "NOT_PNG_FILE"
+    file_buffer = io.BytesIO(file)
+    try:
+        img = Image.open(file_buffer)
+        img.close()
+    except Exception:
+        return False, "BAD_PNG_FILE"
+    finally:
+        file_buffer.close()
+    return True, None
+
+def encode_png(img_data):
+    buffer = io.BytesIO()
+    Image.fromarray(img_data).save(buffer,format="PNG")
+    return buffer.getvalue()
+
+def png_chunk(chunk_type, data):
+    return struct.pack(">I",len(data))+chunk_type+data+struct.pack(">I",zlib.crc32(chunk_type+data))
+
+# Small valid header claiming 16000x16000 16-bit RGBA, followed by a highly compressible IDAT
+def zip_bomb():
+    header = struct.pack(">IIBBBBB",16000,16000,16,6,0,0,0)
+    idat = zlib.compress(b"\0"*(64*1024*1024),9)
+    return bytes.fromhex("89504E470D0A1A0A")+png_chunk(b"IHDR",header)+png_chunk(b"IDAT",idat)+png_chunk(b"IEND",b"")
+
+# Valid 4K image with a single flipped bit in the last IDAT chunk
+def corrupted(file):
+    file = bytearray(file)
+    file[len(file)-20] ^= 1
+    return bytes(file)
+
+def measure(check, file):
+    best_time = None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = check(file)
+        elapsed = time.perf_counter()-start
+        best_time = elapsed if best_time is None else min(best_time,elapsed)
+    return best_time, result
+
+def main():
+    rng = np.random.default_rng(0)
+    small = encode_png(rng.integers(0,256,(64,64,3),dtype=np.uint8))
+    large = encode_png(rng.integers(0,256,(2160,3840,4),dtype=np.uint8))
+    inputs = [("64px RGB",small),("4K RGBA",large),("zip bomb",zip_bomb()),("4K bad CRC",corrupted(large)),("truncated 4K",large[:len(large)//2])]
+    checks = [("PIL open",legacy_check_png),("chunks",check_png),("strict",lambda file: check_png(file,strict=True))]
+
+    print("{:<14}{:>10}".format("input","KiB")+"".join("{:>26}".format(i[0]+" ms (result)") for i in checks))
+    for name, file in inputs:
+        row = "{:<14}{:>10.0f}".format(name,len(file)/1024)
+        for _, check in checks:
+            elapsed, result = measure(check,file)
+            row += "{:>26}".format("{:.3f} ({})".format(elapsed*1000,"ok" if result[0] else result[1]))
+        print(row)
+
+if __name__=="__main__":
+    main()
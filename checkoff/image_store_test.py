@@ -0,0 +1,35 @@
+import pytest
+import asyncio
+import os
+import sys
+
+# Storage race tests run image_store directly against an in-memory Redis, as the interleavings they need cannot
+# be set up through the API
+fakeredis = pytest.importorskip("fakeredis")
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","app"))
+import image_store
+
+# Stored as-is, so any bytes do - spanning several chunks
+FILE_BYTES = bytes(range(256))*(3*image_store.BLOB_CHUNK_SIZE//256+1)
+
+# Test storing an image whose blob is released between the existence check and the write script - the blob has
+# to be staged again rather than recreated empty
+def test_image_store_blob_released_before_write():
+    async def run():
+        redis_client = fakeredis.FakeAsyncRedis()
+        await image_store.load_scripts(redis_client)
+        await image_store.store_image(redis_client,"a",FILE_BYTES)
+        exists = redis_client.exists
+        async def exists_then_release(*keys):
+            result = await exists(*keys)
+            await image_store.delete_image(redis_client,"a")
+            return result
+        redis_client.exists = exists_then_release
+        await image_store.store_image(redis_client,"b",FILE_BYTES)
+        redis_client.exists = exists
+        file, _ = await image_store.get_original(redis_client,"b")
+        assert file==FILE_BYTES
+        await image_store.store_image(redis_client,"c",FILE_BYTES)
+        file, _ = await image_store.get_original(redis_client,"c")
+        assert file==FILE_BYTES
+    asyncio.run(run())
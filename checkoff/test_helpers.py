@@ -25,4 +25,12 @@ def make_request(http_bytes):
 def make_request_from_file(file):
     with open(file,"rb") as f:
         raw_req = f.read()
-    return make_request(raw_req)
\ No newline at end of file
+    return make_request(raw_req)
+
+# Make a request from a file whose {name} placeholders are filled in from fields
+def make_request_from_template(file, **fields):
+    with open(file,"rb") as f:
+        raw_req = f.read()
+    for name, value in fields.items():
+        raw_req = raw_req.replace("{{{}}}".format(name).encode(),value.encode())
+    return make_request(raw_req)
@@ -1,5 +1,5 @@
 import pytest
-from test_helpers import make_request_from_file
+from test_helpers import make_request_from_file, make_request_from_template
 import json
 
 # Test GET / basic functionality
@@ -302,6 +302,36 @@ def test_get_contributors_offset():
         for i in indexes: make_request_from_file("http_files/contributors_username_delete_{}.http".format(i))
         assert False
 
+# Test GET /contributors with a cursor - an empty cursor starts from the first page, and each page's next_cursor
+# resumes after it until the last page, whose next_cursor is null
+def test_get_contributors_cursor():
+    indexes = list(range(1,6))
+    try:
+        for i in indexes:
+            make_request_from_file("http_files/contributors_post_{}.http".format(i))
+        status, _, body = make_request_from_file("http_files/contributors_get_cursor_1.http")
+        assert status==200
+        body = json.loads(body)
+        assert len(body)==2
+        assert [i["username"] for i in body["contributors"]]==["aaaaa","aaaaa1","bbbbb"]
+        assert isinstance(body["next_cursor"],str)
+        status, _, body = make_request_from_template("http_files/contributors_get_cursor_2.http",cursor=body["next_cursor"])
+        assert status==200
+        body = json.loads(body)
+        assert [i["username"] for i in body["contributors"]]==["ddddd","sssss"]
+        assert body["next_cursor"]==None
+        for i in indexes: make_request_from_file("http_files/contributors_username_delete_{}.http".format(i))
+    except Exception as e:
+        print(e)
+        for i in indexes: make_request_from_file("http_files/contributors_username_delete_{}.http".format(i))
+        assert False
+
+# Test GET /contributors with a malformed cursor
+def test_get_contributors_cursor_error():
+    status, _, body = make_request_from_file("http_files/contributors_get_cursor_3.http")
+    assert status==400
+    assert json.loads(body)=={"error": "INVALID_CURSOR"}
+
 # Test GET /contributors with combined query params
 def test_get_contributors_combined_query():
     indexes = list(range(1,6))
@@ -322,3 +352,141 @@ def test_get_contributors_combined_query():
         for i in indexes: make_request_from_file("http_files/contributors_username_delete_{}.http".format(i))
         assert False
         
+
+# Test GET /stats/overlay for reporting of overlay cache counters
+def test_stats_overlay_get_basic():
+    status, _, body = make_request_from_file("http_files/stats_overlay_get_basic.http")
+    assert status==200
+    body = json.loads(body)
+    for i in ["hits","misses","evictions","entries","bytes_used","byte_budget"]:
+        assert i in body
+    assert body["bytes_used"]<=body["byte_budget"]
+
+# Test POST and GET /contributors:batch basic functionality
+def test_contributors_batch_basic():
+    try:
+        make_request_from_file("http_files/contributors_post_1.http")
+        status, _, body = make_request_from_file("http_files/contributors_batch_post_1.http")
+        assert status==200
+        body = json.loads(body)
+        assert [i["new_user_created"] for i in body["results"]]==[False,True]
+        status, _, body = make_request_from_file("http_files/contributors_batch_get_1.http")
+        assert status==200
+        body = json.loads(body)
+        assert [i["username"] for i in body]==["aaaaa","zzzzz","ddddd"]
+        assert body[0]["name"]=="bbbbb" and body[2]["name"]=="aaaaa"
+        assert body[1]["error"]=="CONTRIBUTOR_NOT_FOUND"
+        make_request_from_file("http_files/contributors_username_delete_1.http")
+        make_request_from_file("http_files/contributors_username_delete_4.http")
+    except Exception as e:
+        print(e)
+        make_request_from_file("http_files/contributors_username_delete_1.http")
+        make_request_from_file("http_files/contributors_username_delete_4.http")
+        assert False
+
+# Upload the image of images_post_1.http as contributor aaaaa, returning its identifier
+def post_image():
+    make_request_from_file("http_files/contributors_post_1.http")
+    status, _, body = make_request_from_file("http_files/images_post_1.http")
+    assert status==200
+    return json.loads(body)["path"].split("/")[-1]
+
+# Test GET and DELETE /images/{identifier} basic functionality
+def test_images_delete_basic():
+    identifier = None
+    try:
+        identifier = post_image()
+        status, headers, body = make_request_from_template("http_files/images_get_1.http",identifier=identifier)
+        assert status==200
+        assert headers["Content-Type"]=="image/png"
+        assert "ETag" in headers
+        status, _, body = make_request_from_template("http_files/images_delete_1.http",identifier=identifier)
+        assert status==200
+        assert json.loads(body)=={"success": True}
+        status, _, body = make_request_from_template("http_files/images_get_1.http",identifier=identifier)
+        assert status==404
+        status, _, body = make_request_from_template("http_files/images_delete_1.http",identifier=identifier)
+        assert status==404
+        make_request_from_file("http_files/contributors_username_delete_1.http")
+    except Exception as e:
+        print(e)
+        if not identifier==None: make_request_from_template("http_files/images_delete_1.http",identifier=identifier)
+        make_request_from_file("http_files/contributors_username_delete_1.http")
+        assert False
+
+# Test POST /images deduplication - the same content uploaded twice is stored once
+def test_images_post_dedup():
+    identifiers = []
+    try:
+        _, _, body = make_request_from_file("http_files/stats_images_get_basic.http")
+        before = json.loads(body)
+        identifiers.append(post_image())
+        identifiers.append(post_image())
+        status, _, body = make_request_from_file("http_files/stats_images_get_basic.http")
+        assert status==200
+        after = json.loads(body)
+        assert after["references"]-before["references"]==2
+        assert after["unique_blobs"]-before["unique_blobs"]<=1
+        assert after["bytes_saved"]>before["bytes_saved"]
+        for i in identifiers: make_request_from_template("http_files/images_delete_1.http",identifier=i)
+        make_request_from_file("http_files/contributors_username_delete_1.http")
+    except Exception as e:
+        print(e)
+        for i in identifiers: make_request_from_template("http_files/images_delete_1.http",identifier=i)
+        make_request_from_file("http_files/contributors_username_delete_1.http")
+        assert False
+
+# Test GET /images/{identifier} with a Range header - the range is sent back as 206 Partial Content, and a
+# Range with If-Range naming the frame sent resumes that same frame
+def test_images_get_range():
+    identifier = None
+    try:
+        identifier = post_image()
+        status, headers, body = make_request_from_template("http_files/images_get_range_1.http",identifier=identifier)
+        assert status==206
+        assert len(body)==10
+        assert headers["Content-Range"].startswith("bytes 0-9/")
+        size = int(headers["Content-Range"].split("/")[1])
+        status, headers, body = make_request_from_template("http_files/images_get_if_range_1.http",identifier=identifier,etag=headers["ETag"])
+        assert status==206
+        assert headers["Content-Range"]=="bytes 10-{}/{}".format(size-1,size)
+        assert len(body)==size-10
+        make_request_from_template("http_files/images_delete_1.http",identifier=identifier)
+        make_request_from_file("http_files/contributors_username_delete_1.http")
+    except Exception as e:
+        print(e)
+        if not identifier==None: make_request_from_template("http_files/images_delete_1.http",identifier=identifier)
+        make_request_from_file("http_files/contributors_username_delete_1.http")
+        assert False
+
+# Test GET /images/{identifier} with a Range past the end of the image
+def test_images_get_range_not_satisfiable():
+    identifier = None
+    try:
+        identifier = post_image()
+        status, headers, body = make_request_from_template("http_files/images_get_range_2.http",identifier=identifier)
+        assert status==416
+        assert headers["Content-Range"].startswith("bytes */")
+        make_request_from_template("http_files/images_delete_1.http",identifier=identifier)
+        make_request_from_file("http_files/contributors_username_delete_1.http")
+    except Exception as e:
+        print(e)
+        if not identifier==None: make_request_from_template("http_files/images_delete_1.http",identifier=identifier)
+        make_request_from_file("http_files/contributors_username_delete_1.http")
+        assert False
+
+# Test PUT /images/{identifier} with the content the image already has
+def test_images_put_unchanged():
+    identifier = None
+    try:
+        identifier = post_image()
+        status, _, body = make_request_from_template("http_files/images_put_1.http",identifier=identifier)
+        assert status==200
+        assert json.loads(body)=={"success": True, "image_changed": False}
+        make_request_from_template("http_files/images_delete_1.http",identifier=identifier)
+        make_request_from_file("http_files/contributors_username_delete_1.http")
+    except Exception as e:
+        print(e)
+        if not identifier==None: make_request_from_template("http_files/images_delete_1.http",identifier=identifier)
+        make_request_from_file("http_files/contributors_username_delete_1.http")
+        assert False